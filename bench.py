@@ -0,0 +1,115 @@
+"""Benchmarks for the send path
+
+Runs against the database in config.yaml (with the migrations applied) and the fake
+Twilio client, so no messages are sent.  Rows written by a run are deleted afterwards.
+
+    python bench.py msglog --rows 300
+    python bench.py segments --bodies 20000
+"""
+import argparse
+import os
+import random
+import time
+import psycopg2.extensions
+import db
+from fakes import FakeTwilioClient, FakeJobStore, FakeSuppressionList, FakeNumberPool
+from jobs import SendQueue
+from pacing import SendScheduler
+from segments import segment_info
+from templating import MessageTemplate
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Counts statements sent to the server"""
+    executed = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.executed += 1
+        return super().execute(query, vars)
+
+
+def use_counting_pool():
+    pg = db.settings["pg"]
+    db._pool = db.ConnectionPool(1, pg.get("pool_max", 10),
+                                 host="localhost",
+                                 dbname=pg["dbname"],
+                                 user=pg["user"],
+                                 password=pg["password"],
+                                 cursor_factory=CountingCursor)
+    db._pool_pid = os.getpid()
+
+
+class PerRowMessages:
+    """The old logging path: one INSERT per recipient"""
+    @staticmethod
+    def add_messages(rows):
+        for row in rows:
+            db.Messages.add_message(*row)
+
+
+def cleanup(prefix):
+    with db.get_db() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM messages WHERE message LIKE %s", [f"{prefix}%"])
+
+
+def bench_msglog(args):
+    use_counting_pool()
+    recipients = [(f"Bench {i}", f"+1555{i:07d}", 0) for i in range(args.rows)]
+    results = {}
+    for name, messages in (("per-row", PerRowMessages), ("batched", db.Messages)):
+        body = f"bench-{name}-{time.time()}"
+        client = FakeTwilioClient()
+        # No pacing: this measures the database side only
+        queue = SendQueue(client=client, jobs=FakeJobStore(), messages=messages,
+                          concurrency=args.concurrency,
+                          suppressions=FakeSuppressionList(),
+                          numbers=FakeNumberPool(),
+                          scheduler=SendScheduler(client, rate=1e9, burst=args.rows))
+        CountingCursor.executed = 0
+        start = time.perf_counter()
+        job = queue.submit("BENCH", 0, "+15550000000", body, recipients)
+        queue.wait(job.id)
+        elapsed = time.perf_counter() - start
+        results[name] = (CountingCursor.executed, elapsed)
+        cleanup(body)
+    print(f"{args.rows} recipients")
+    for name, (statements, elapsed) in results.items():
+        print(f"  {name:8} {statements:6} statements  {elapsed * 1000:8.1f} ms")
+
+
+def bench_segments(args):
+    """Segment counting only; doesn't touch the database"""
+    rng = random.Random(1)
+    words = ["practice", "tonight", "7pm", "bring", "music", "[band]", "€5", "café", "don’t", "🎺", "{ok}"]
+    bodies = [" ".join(rng.choice(words) for _ in range(rng.randint(3, 80))) for _ in range(args.bodies)]
+    start = time.perf_counter()
+    for body in bodies:
+        segment_info(body)
+    elapsed = time.perf_counter() - start
+    print(f"{args.bodies} bodies  {elapsed * 1000:8.1f} ms  {args.bodies / elapsed:10.0f} bodies/s")
+    template = MessageTemplate("Hi {first_name}, " + bodies[0])
+    names = [f"Bench{i} Recipient" for i in range(args.bodies)]
+    start = time.perf_counter()
+    estimate = template.estimate(names)
+    elapsed = time.perf_counter() - start
+    print(f"{estimate.recipients} personalized  {elapsed * 1000:8.1f} ms  "
+          f"{estimate.recipients / elapsed:10.0f} recipients/s  ({estimate.segments} segments)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="scenario", required=True)
+    msglog = sub.add_parser("msglog", help="message logging for one group send")
+    msglog.add_argument("--rows", type=int, default=300)
+    msglog.add_argument("--concurrency", type=int, default=4)
+    msglog.set_defaults(func=bench_msglog)
+    segments = sub.add_parser("segments", help="segment counting for broadcast previews")
+    segments.add_argument("--bodies", type=int, default=20000)
+    segments.set_defaults(func=bench_segments)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
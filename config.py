@@ -1,7 +1,31 @@
+import threading
 import yaml
-from twilio.rest import Client
+from outbound import HttpClient, TwilioSessionClient
 
 with open("config.yaml", "r") as f:
     settings = yaml.load(f, Loader=yaml.Loader)
 
-twilio = Client(settings["twilio"]["sid"], settings["twilio"]["token"])
+
+class LazyClient:
+    """Stands in for a client that is only built when it's first used"""
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return getattr(self._client, name)
+
+
+def _twilio_client():
+    from twilio.rest import Client
+    return Client(settings["twilio"]["sid"], settings["twilio"]["token"],
+                  http_client=TwilioSessionClient(http))
+
+
+http = HttpClient(**settings.get("http", {}))
+twilio = LazyClient(_twilio_client)
@@ -1,17 +1,308 @@
+import atexit
+import os
+import threading
+import time
+import weakref
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
 import psycopg2
+from psycopg2 import pool, extensions, extras
 from loguru import logger
 from flask_login import UserMixin
 from config import settings
-from utils import get_new_number
+from cache import TTLCache
+from metrics import metrics
+from querylog import QueryConnection
+
+
+class PooledConnection:
+    """Wraps a pooled psycopg2 connection so that close() hands it back to the pool
+
+    Leaving a ``with get_db() as conn`` block also returns the connection, so an exception
+    inside the block can't leak it.
+    """
+    def __init__(self, owner, conn):
+        self._owner = owner
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            return self._conn.__exit__(exc_type, exc_val, exc_tb)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._owner.putconn(conn)
+
+
+class ConnectionPool:
+    """Thread-safe pool of connections shared by everything in one worker process
+
+    Checkouts wait up to ``timeout`` seconds for a free connection instead of failing
+    straight away, and connections that have sat idle for ``ping_after`` seconds are
+    checked with ``SELECT 1`` before being handed out.
+    """
+    def __init__(self, minconn, maxconn, timeout=10, ping_after=30, **kwargs):
+        self._pool = pool.ThreadedConnectionPool(minconn, maxconn, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.stats = {"checkouts": 0, "in_use": 0, "waits": 0, "wait_seconds": 0.0,
+                      "timeouts": 0, "discarded": 0}
+
+    def getconn(self):
+        if not self._slots.acquire(blocking=False):
+            start = time.monotonic()
+            acquired = self._slots.acquire(timeout=self.timeout)
+            with self._lock:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += time.monotonic() - start
+                if not acquired:
+                    self.stats["timeouts"] += 1
+            if not acquired:
+                raise pool.PoolError(f"No database connection free after {self.timeout} seconds")
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+        return PooledConnection(self, conn)
+
+    def putconn(self, conn):
+        close = bool(conn.closed) or conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE
+        if close:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            with self._lock:
+                self.stats["in_use"] -= 1
+            self._slots.release()
+
+    def _checkout(self):
+        # A ThreadedConnectionPool only grows to maxconn, and our semaphore guarantees a
+        # free slot, so at most one replacement connection is needed here
+        conn = self._pool.getconn()
+        if not self._healthy(conn):
+            with self._lock:
+                self.stats["discarded"] += 1
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        if not conn.autocommit:
+            conn.set_session(autocommit=True)
+        return conn
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def size(self):
+        return len(self._pool._pool) + len(self._pool._used)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Pools inherited across a fork are kept referenced so their sockets (shared with the
+# parent) are never closed from the child
+_inherited_pools = []
+
+
+def get_pool():
+    """Return this process's connection pool, creating it on first use"""
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                if _pool is not None:
+                    _inherited_pools.append(_pool)
+                pg = settings["pg"]
+                _pool = ConnectionPool(pg.get("pool_min", 1),
+                                       pg.get("pool_max", 10),
+                                       timeout=pg.get("pool_timeout", 10),
+                                       ping_after=pg.get("pool_ping_after", 30),
+                                       connection_factory=QueryConnection if pg.get("query_log", True) else None,
+                                       host="localhost",
+                                       dbname=pg['dbname'],
+                                       user=pg['user'],
+                                       password=pg['password'])
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def pool_stats():
+    """Counters for this worker's connection pool"""
+    if _pool is None or _pool_pid != os.getpid():
+        return {}
+    stats = dict(_pool.stats)
+    stats["size"] = _pool.size()
+    stats["max"] = _pool.maxconn
+    return stats
 
 
 def get_db():
-    conn = psycopg2.connect(host="localhost",
-                            dbname=settings['pg']['dbname'],
-                            user=settings['pg']['user'],
-                            password=settings['pg']['password'])
-    conn.set_session(autocommit=True)
-    return conn
+    """Borrow a connection from the pool; close() returns it"""
+    return get_pool().getconn()
+
+
+class UserCache(TTLCache):
+    """Per-worker TTLCache of loaded users that empties itself when any worker changes a user
+
+    Triggers bump the single row in user_version on every change to users.  The cache reads
+    that number at most every ``check_interval`` seconds and drops every entry when it has
+    moved, so an approval, phone or corps changed in another worker is seen within that time
+    instead of once the entry's ttl runs out.
+    """
+    def __init__(self, maxsize=1000, ttl=60, check_interval=5):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.check_interval = check_interval
+        self.version = None
+        self.checks = 0
+        self.resets = 0
+        self._checked = 0
+        self._version_lock = threading.Lock()
+
+    def _fresh(self):
+        if time.monotonic() - self._checked < self.check_interval:
+            return
+        with self._version_lock:
+            if time.monotonic() - self._checked < self.check_interval:
+                return
+            with get_db() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT version FROM user_version")
+                    version = cursor.fetchone()[0]
+            cursor.close()
+            conn.close()
+            self.checks += 1
+            if version != self.version:
+                self.clear()
+                self.version = version
+                self.resets += 1
+            self._checked = time.monotonic()
+
+    def get(self, key, default=None):
+        self._fresh()
+        return super().get(key, default)
+
+    def stats(self):
+        return dict(super().stats(), version=self.version, checks=self.checks, resets=self.resets)
+
+
+_user_cache_cfg = settings.get("cache", {}).get("users", {})
+# Flask-Login loads the user on every request, so keep recently seen users per worker
+user_cache = UserCache(maxsize=_user_cache_cfg.get("size", 1000), ttl=_user_cache_cfg.get("ttl", 60),
+                       check_interval=_user_cache_cfg.get("check_interval", 5))
+
+
+class ReferenceData:
+    """Per-worker copy of the divisions and corps tables
+
+    Both tables are loaded together into dicts keyed by id.  Triggers bump the single row
+    in reference_version whenever either table changes, and the copy checks that number at
+    most every ``check_interval`` seconds, reloading when it has moved.  Between checks,
+    lookups don't touch the database at all.
+    """
+    def __init__(self, check_interval=30):
+        self.check_interval = check_interval
+        self.version = None
+        self.reloads = 0
+        self.checks = 0
+        self._divisions = {}
+        self._corps = {}
+        self._by_division = {}
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _fresh(self):
+        if time.monotonic() - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._checked < self.check_interval:
+                return
+            with get_db() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT version FROM reference_version")
+                    version = cursor.fetchone()[0]
+                    if version != self.version:
+                        cursor.execute("SELECT id, name FROM divisions WHERE id > 0 ORDER BY id")
+                        divisions = dict(cursor.fetchall())
+                        cursor.execute("SELECT id, name, div_id FROM corps ORDER BY id")
+                        corps = {corps_id: (name, div_id) for corps_id, name, div_id in cursor.fetchall()}
+            cursor.close()
+            conn.close()
+            self.checks += 1
+            if version != self.version:
+                by_division = {}
+                for corps_id, (name, div_id) in corps.items():
+                    by_division.setdefault(div_id, []).append((corps_id, name))
+                self._divisions, self._corps, self._by_division = divisions, corps, by_division
+                self.version = version
+                self.reloads += 1
+            self._checked = time.monotonic()
+
+    def divisions(self):
+        """(id, name) for every division, in id order"""
+        self._fresh()
+        return list(self._divisions.items())
+
+    def corps_in(self, div_id):
+        """(id, name) for the corps in a division, in id order"""
+        self._fresh()
+        return list(self._by_division.get(int(div_id), []))
+
+    def corps_name(self, corps_id):
+        self._fresh()
+        corps = self._corps.get(int(corps_id))
+        if corps is None:
+            # Possibly a corps added since the last check
+            self.invalidate()
+            self._fresh()
+            corps = self._corps.get(int(corps_id))
+        return corps[0] if corps else None
+
+    def invalidate(self):
+        """Check the version on the next lookup"""
+        self._checked = 0
+
+    def stats(self):
+        return {"version": self.version,
+                "divisions": len(self._divisions),
+                "corps": len(self._corps),
+                "checks": self.checks,
+                "reloads": self.reloads}
+
+
+_reference_cfg = settings.get("cache", {}).get("reference", {})
+reference_data = ReferenceData(check_interval=_reference_cfg.get("check_interval", 30))
 
 
 class User(UserMixin):
@@ -27,6 +318,9 @@ class User(UserMixin):
 
     @staticmethod
     def get(user_id):
+        cached = user_cache.get(user_id)
+        if cached is not None:
+            return cached
         with get_db() as conn:
             with conn.cursor() as cursor:
                 sql = (f"SELECT id, name, email, phone, profile_pic, corps_id, is_admin, is_approved "
@@ -47,6 +341,7 @@ class User(UserMixin):
                     is_admin=user[6],
                     is_approved=user[7]
                     )
+        user_cache.set(user_id, user)
         return user
 
     @staticmethod
@@ -58,6 +353,7 @@ class User(UserMixin):
                                [id_, name, email, profile_pic])
         cursor.close()
         conn.close()
+        user_cache.pop(id_)
         logger.info(f"User {name} successfully added to database.")
 
     @staticmethod
@@ -94,6 +390,7 @@ class User(UserMixin):
                                      )
         cursor.close()
         conn.close()
+        user_cache.set(approved_user.id, approved_user)
         return approved_user
 
     @staticmethod
@@ -105,6 +402,7 @@ class User(UserMixin):
                 user_name = cursor.fetchone()[0]
         cursor.close()
         conn.close()
+        user_cache.pop(id_)
         logger.info(f"{user_name}({id_}) successfully updated their phone number to {phone}")
 
     @staticmethod
@@ -112,25 +410,24 @@ class User(UserMixin):
         with get_db() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("UPDATE users SET corps_id = %s WHERE id = %s", [corps_id, id_])
-                cursor.execute("SELECT name FROM corps WHERE id = %s", [corps_id])
-                corps_name = cursor.fetchone()[0]
         cursor.close()
         conn.close()
+        user_cache.pop(id_)
+        corps_name = reference_data.corps_name(corps_id)
         logger.info(f"User: {id_} successfully linked to {corps_name} corps.")
         return corps_name
 
     @staticmethod
     def get_divisions():
-        with get_db() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT id, name FROM divisions WHERE id > 0 ORDER BY id")
-                divisions = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return divisions
+        return reference_data.divisions()
 
     @staticmethod
     def get_corps_phone(corps_id):
+        """The corps' main sending number
+
+        Numbers are bought ahead of time by numberpool.Provisioner, so a corps that doesn't
+        have one yet is given the shared system number for now.
+        """
         with get_db() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("SELECT '+1' || phone as phone, name FROM corps WHERE id = %s", [corps_id])
@@ -138,24 +435,152 @@ class User(UserMixin):
                 if corps[0]:
                     phone = corps[0]
                 else:
-                    cursor.execute("SELECT substring(phone, 1, 3) as area_code "
-                                   "FROM users WHERE corps_id = %s LIMIT 1", [corps_id])
-                    area_code = cursor.fetchone()[0]
-                    phone = get_new_number(area_code, corps[1])
-                    cursor.execute("UPDATE corps SET phone = %s WHERE id = %s", [phone[2:], corps_id])
+                    cursor.execute("SELECT phone FROM corps_numbers WHERE corps_id = %s "
+                                   "ORDER BY created_at LIMIT 1", [corps_id])
+                    fetch = cursor.fetchone()
+                    if fetch:
+                        phone = f"+1{fetch[0]}"
+                        cursor.execute("UPDATE corps SET phone = %s WHERE id = %s", [fetch[0], corps_id])
+                    else:
+                        phone = settings["twilio"]["phone_num"]
+                        logger.warning(f"{corps[1]} has no sending number yet; using {phone}")
         cursor.close()
         conn.close()
         return phone
 
+    @staticmethod
+    def get_corps_contacts(corps_id):
+        """Phone numbers of the approved users for a corps"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT '+1' || phone FROM users "
+                               "WHERE corps_id = %s AND is_approved = 1 AND phone IS NOT NULL",
+                               [corps_id])
+                phones = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        conn.close()
+        return phones
+
     @staticmethod
     def get_corps(div_id):
+        return reference_data.corps_in(div_id)
+
+
+GroupMembers = namedtuple("GroupMembers", ["ids", "names", "phones"])
+
+
+class GroupIndex:
+    """Per-worker cache of group membership keyed by group id
+
+    Each group is held as a compact array of recipient ids with matching names and E.164
+    numbers, so sends don't join recipients against recipient_groups every time.
+    Recipients functions that change membership or numbers invalidate the affected groups
+    straight away in this worker.  Changes made by other workers are caught by triggers that
+    bump the single row in membership_version: every lookup reads that number first and
+    drops the whole cache when it has moved, so a send never uses stale membership.
+    """
+    def __init__(self, maxsize=2000, ttl=60):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.version = None
+        self.reloads = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _current_version():
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT version FROM membership_version")
+                version = cursor.fetchone()[0]
+        cursor.close()
+        conn.close()
+        return version
+
+    def members(self, group_ids):
+        """Return {group_id: GroupMembers}, loading any missing groups with one query"""
+        version = self._current_version()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self._cache.clear()
+                    self.version = version
+                    self.reloads += 1
+        found = {}
+        missing = []
+        for group_id in group_ids:
+            members = self._cache.get(group_id)
+            if members is None:
+                missing.append(group_id)
+            else:
+                found[group_id] = members
+        if missing:
+            loaded = self._load(missing)
+            with self._lock:
+                # Rows loaded under an older version may already be stale; use them, don't keep them
+                keep = version == self.version
+                for group_id in missing:
+                    found[group_id] = loaded[group_id]
+                    if keep:
+                        self._cache.set(group_id, loaded[group_id])
+        return found
+
+    @staticmethod
+    def _load(group_ids):
         with get_db() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT id, name FROM corps WHERE div_id = %s ORDER BY id", [div_id])
-                corps = cursor.fetchall()
+                cursor.execute("SELECT rg.group_id, r.id, r.name, r.phone "
+                               "FROM recipients r "
+                               "INNER JOIN recipient_groups rg on r.id = rg.recipient_id "
+                               "WHERE rg.group_id = ANY(%s) "
+                               "ORDER BY rg.group_id, r.id", [list(group_ids)])
+                rows = cursor.fetchall()
         cursor.close()
         conn.close()
-        return corps
+        loaded = {group_id: ([], [], []) for group_id in group_ids}
+        for group_id, recipient_id, name, phone in rows:
+            ids, names, phones = loaded[group_id]
+            ids.append(recipient_id)
+            names.append(name)
+            phones.append(f"+1{phone}")
+        return {group_id: GroupMembers(array("l", ids), tuple(names), tuple(phones))
+                for group_id, (ids, names, phones) in loaded.items()}
+
+    def resolve(self, group_ids):
+        """Recipients of all the given groups as (name, phone, id, group_id) rows
+
+        Each number is listed once, under the first group given, even when it belongs to
+        more than one recipient record.
+        """
+        group_ids = [int(group_id) for group_id in group_ids]
+        groups = self.members(group_ids)
+        seen = set()
+        recipients = []
+        for group_id in group_ids:
+            members = groups[group_id]
+            for i in range(len(members.ids)):
+                phone = members.phones[i]
+                if phone not in seen:
+                    seen.add(phone)
+                    recipients.append((members.names[i], phone, members.ids[i], group_id))
+        return recipients
+
+    def invalidate_group(self, group_id):
+        self._cache.pop(int(group_id))
+
+    def invalidate_all(self):
+        self._cache.clear()
+
+    def invalidate_recipient(self, recipient_id):
+        """Drop every cached group the recipient belongs to"""
+        for group_id, members in self._cache.items():
+            if recipient_id in members.ids:
+                self._cache.pop(group_id)
+
+    def stats(self):
+        return dict(self._cache.stats(), version=self.version, reloads=self.reloads)
+
+
+_group_index_cfg = settings.get("cache", {}).get("groups", {})
+group_index = GroupIndex(maxsize=_group_index_cfg.get("size", 2000), ttl=_group_index_cfg.get("ttl", 60))
 
 
 class Recipients:
@@ -183,25 +608,19 @@ class Recipients:
     def get(id_):
         with get_db() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT name, phone "
-                               "FROM recipients "
-                               "WHERE id = %s",
+                cursor.execute("SELECT r.name, r.phone, "
+                               "array_remove(array_agg(rg.group_id), NULL) "
+                               "FROM recipients r "
+                               "LEFT JOIN recipient_groups rg on r.id = rg.recipient_id "
+                               "WHERE r.id = %s "
+                               "GROUP BY r.id",
                                [id_])
-                recipient = cursor.fetchone()
-                name = recipient[0]
-                phone = recipient[1]
-                cursor.execute("SELECT group_ID "
-                               "FROM recipient_groups "
-                               "WHERE recipient_id = %s", [id_])
-                fetch = cursor.fetchall()
-                groups = []
-                for row in fetch:
-                    groups.append(row[0])
+                fetch = cursor.fetchone()
                 recipient = Recipients(
                     id_=id_,
-                    name=name,
-                    phone=phone,
-                    groups=groups
+                    name=fetch[0],
+                    phone=fetch[1],
+                    groups=fetch[2]
                 )
         cursor.close()
         conn.close()
@@ -217,6 +636,7 @@ class Recipients:
                                [name, phone, id_])
         cursor.close()
         conn.close()
+        group_index.invalidate_recipient(id_)
         logger.info(f"Recipient {name} updated.")
 
     @staticmethod
@@ -227,14 +647,74 @@ class Recipients:
                                "VALUES (%s, %s)", [recipient_id, group_id])
         cursor.close()
         conn.close()
+        group_index.invalidate_group(group_id)
 
     @staticmethod
     def clear_groups(recipient_id):
         with get_db() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("DELETE FROM recipient_groups WHERE recipient_id = %s", [recipient_id])
+                cursor.execute("DELETE FROM recipient_groups WHERE recipient_id = %s "
+                               "RETURNING group_id", [recipient_id])
+                group_ids = [row[0] for row in cursor.fetchall()]
         cursor.close()
         conn.close()
+        for group_id in group_ids:
+            group_index.invalidate_group(group_id)
+
+    @staticmethod
+    def set_groups(recipient_id, group_ids):
+        """Make group_ids the recipient's groups, changing only what differs, in one transaction
+
+        Returns the (added, removed) group ids.
+        """
+        group_ids = sorted({int(group_id) for group_id in group_ids})
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM recipient_groups "
+                               "WHERE recipient_id = %s AND NOT (group_id = ANY(%s::integer[])) "
+                               "RETURNING group_id", [recipient_id, group_ids])
+                removed = [row[0] for row in cursor.fetchall()]
+                cursor.execute("INSERT INTO recipient_groups (recipient_id, group_id) "
+                               "SELECT %s, g FROM unnest(%s::integer[]) g "
+                               "WHERE NOT EXISTS (SELECT 1 FROM recipient_groups rg "
+                               "                  WHERE rg.recipient_id = %s AND rg.group_id = g) "
+                               "RETURNING group_id", [recipient_id, group_ids, recipient_id])
+                added = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        conn.close()
+        for group_id in added + removed:
+            group_index.invalidate_group(group_id)
+        return added, removed
+
+    @staticmethod
+    def add_to_group(group_id, recipient_ids):
+        """Add many recipients to one group with a single statement; returns how many were added"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO recipient_groups (recipient_id, group_id) "
+                               "SELECT r, %s FROM unnest(%s::integer[]) r "
+                               "WHERE NOT EXISTS (SELECT 1 FROM recipient_groups rg "
+                               "                  WHERE rg.recipient_id = r AND rg.group_id = %s)",
+                               [group_id, sorted(set(recipient_ids)), group_id])
+                added = cursor.rowcount
+        cursor.close()
+        conn.close()
+        group_index.invalidate_group(group_id)
+        return added
+
+    @staticmethod
+    def remove_from_group(group_id, recipient_ids):
+        """Remove many recipients from one group with a single statement"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM recipient_groups "
+                               "WHERE group_id = %s AND recipient_id = ANY(%s::integer[])",
+                               [group_id, list(recipient_ids)])
+                removed = cursor.rowcount
+        cursor.close()
+        conn.close()
+        group_index.invalidate_group(group_id)
+        return removed
 
     @staticmethod
     def get_groups_by_user(corps_id):
@@ -265,18 +745,92 @@ class Recipients:
     @staticmethod
     def get_recipients_by_group(group):
         """This function pulls recipients for a specified group"""
+        return group_index.resolve([group])
+
+    @staticmethod
+    def get_recipients_by_groups(groups):
+        """This function pulls recipients for several groups, listing each recipient once"""
+        return group_index.resolve(groups)
+
+    @staticmethod
+    def get_recipients_by_corps(corps_id):
+        """This function pulls every recipient in a corps, with a group id of 0
+
+        A number shared by several recipient records is listed once, for the oldest record.
+        """
         with get_db() as conn:
             with conn.cursor() as cursor:
-                sql = ("SELECT r.name, '+1' || r.phone as phone, r.id "
-                       "FROM recipients r "
-                       "INNER JOIN recipient_groups rg on r.id = rg.recipient_id "
-                       "WHERE rg.group_id = %s")
-                cursor.execute(sql, [group])
+                cursor.execute("SELECT name, '+1' || phone as phone, id, 0 "
+                               "FROM (SELECT DISTINCT ON (phone) id, name, phone "
+                               "      FROM recipients "
+                               "      WHERE corps_id = %s "
+                               "      ORDER BY phone, id) r "
+                               "ORDER BY id", [corps_id])
                 recipients = cursor.fetchall()
         cursor.close()
         conn.close()
         return recipients
 
+    @staticmethod
+    def get_by_phones(phones):
+        """Recipients matching any of the 10 digit phones
+
+        A phone can belong to recipients in more than one corps, so this returns
+        {phone: [(id, name, corps_id), ...]}.
+        """
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT phone, id, name, corps_id "
+                               "FROM recipients "
+                               "WHERE phone = ANY(%s)", [list(phones)])
+                rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        matches = {}
+        for phone, recipient_id, name, corps_id in rows:
+            matches.setdefault(phone, []).append((recipient_id, name, corps_id))
+        return matches
+
+    @staticmethod
+    def import_rows(corps_id, source, group_ids):
+        """Load (line, name, phone, group names) CSV rows from source into a corps
+
+        The rows are COPYed into a temporary staging table and merged in one transaction:
+        numbers already in the corps are left alone, and every imported number is added to
+        group_ids plus any active groups named (separated by ';') in its group column.
+        Returns the new recipients as (id, name, phone) and the number of rows whose phone
+        was already a recipient.
+        """
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("CREATE TEMP TABLE import_rows "
+                               "(line integer, name text, phone text, groups text) "
+                               "ON COMMIT DROP")
+                cursor.copy_expert("COPY import_rows FROM STDIN WITH (FORMAT csv)", source)
+                cursor.execute("INSERT INTO recipients (name, phone, corps_id) "
+                               "SELECT name, phone, %s FROM import_rows i "
+                               "WHERE NOT EXISTS (SELECT 1 FROM recipients r "
+                               "                  WHERE r.corps_id = %s AND r.phone = i.phone) "
+                               "ORDER BY line "
+                               "RETURNING id, name, phone", [corps_id, corps_id])
+                added = cursor.fetchall()
+                cursor.execute("INSERT INTO recipient_groups (recipient_id, group_id) "
+                               "SELECT DISTINCT r.id, g.id "
+                               "FROM import_rows i "
+                               "INNER JOIN recipients r ON r.corps_id = %s AND r.phone = i.phone "
+                               "INNER JOIN groups g ON g.corps_id = %s AND g.active = 1 "
+                               "     AND (g.id = ANY(%s) "
+                               "          OR g.name = ANY(string_to_array(i.groups, ';'))) "
+                               "WHERE NOT EXISTS (SELECT 1 FROM recipient_groups rg "
+                               "                  WHERE rg.recipient_id = r.id AND rg.group_id = g.id)",
+                               [corps_id, corps_id, list(group_ids)])
+                cursor.execute("SELECT count(*) FROM import_rows")
+                existing = cursor.fetchone()[0] - len(added)
+        cursor.close()
+        conn.close()
+        group_index.invalidate_all()
+        return added, existing
+
     @staticmethod
     def add_group(group_name, corps_id):
         """This function adds a group to the database"""
@@ -311,3 +865,534 @@ class Messages:
                 cursor.execute(sql, [sid, user_id, recipient_id, group_id, message])
         cursor.close()
         conn.close()
+
+    @staticmethod
+    def add_messages(rows):
+        """Insert many (sid, user_id, recipient_id, group_id, message) rows in one statement"""
+        if not rows:
+            return
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                sql = ("INSERT INTO messages "
+                       "(sid, user_id, recipient_id, group_id, message) "
+                       "VALUES %s")
+                extras.execute_values(cursor, sql, rows, page_size=len(rows))
+        cursor.close()
+        conn.close()
+
+    @staticmethod
+    def update_statuses(rows):
+        """Apply (sid, status, error_code) rows in one statement
+
+        Messages that already reached a final status aren't moved back by a late callback.
+        """
+        if not rows:
+            return
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                extras.execute_values(cursor,
+                                      "UPDATE messages AS m "
+                                      "SET status = v.status, error_code = v.error_code, "
+                                      "status_updated_at = now() "
+                                      "FROM (VALUES %s) AS v (sid, status, error_code) "
+                                      "WHERE m.sid = v.sid "
+                                      "AND (m.status IS NULL "
+                                      "     OR m.status NOT IN ('delivered', 'undelivered', 'failed'))",
+                                      rows,
+                                      template="(%s, %s, %s::integer)",
+                                      page_size=len(rows))
+        cursor.close()
+        conn.close()
+
+
+_open_logs = weakref.WeakSet()
+
+
+class MessageLog:
+    """Buffers message rows and writes them with Messages.add_messages
+
+    Rows are written once ``max_rows`` are waiting or ``max_wait`` seconds after the first
+    unwritten row arrived, whichever comes first.  Anything still buffered is written on
+    close() and when the interpreter exits.  Has the same add_message() signature as
+    Messages, so it can be used in its place.
+    """
+    def __init__(self, writer=None, max_rows=None, max_wait=None):
+        cfg = settings.get("message_log", {})
+        self.writer = writer or Messages.add_messages
+        self.max_rows = max_rows or cfg.get("max_rows", 500)
+        self.max_wait = max_wait or cfg.get("max_wait", 2.0)
+        self.flushes = 0
+        self._rows = []
+        self._timer = None
+        self._lock = threading.Lock()
+        _open_logs.add(self)
+
+    def add_message(self, sid, user_id, recipient_id, group_id, message):
+        with self._lock:
+            self._rows.append((sid, user_id, recipient_id, group_id, message))
+            full = len(self._rows) >= self.max_rows
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.max_wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            rows, self._rows = self._rows, []
+            if not rows:
+                return
+            try:
+                self.writer(rows)
+                self.flushes += 1
+            except Exception:
+                # Keep the rows so the next flush can try again
+                self._rows = rows + self._rows
+                logger.exception(f"Failed to write {len(rows)} message log rows")
+
+    def close(self):
+        self.flush()
+        if self._rows:
+            logger.error(f"{len(self._rows)} message log rows could not be written: {self._rows}")
+            self._rows = []
+        _open_logs.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+@atexit.register
+def _flush_message_logs():
+    for log in list(_open_logs):
+        log.close()
+
+
+class Inbound:
+    @staticmethod
+    def add(sid, from_phone, to_phone, body, payload):
+        """Store a webhook's message; returns False if its sid was already stored (a Twilio retry)"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO inbound_messages "
+                               "(sid, from_phone, to_phone, body, payload) "
+                               "VALUES (%s, %s, %s, %s, %s) "
+                               "ON CONFLICT (sid) DO NOTHING",
+                               [sid, from_phone, to_phone, body, extras.Json(payload)])
+                added = cursor.rowcount == 1
+        cursor.close()
+        conn.close()
+        return added
+
+    @staticmethod
+    def claim(limit, timeout):
+        """Mark up to limit unprocessed messages as taken and return them
+
+        SKIP LOCKED lets every worker's processor claim at the same time without
+        handing out the same message twice.  Messages claimed more than timeout seconds
+        ago and never finished (the worker died mid-batch) are handed out again.
+        """
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE inbound_messages SET processed_at = now(), status = 'claimed' "
+                               "WHERE id IN (SELECT id FROM inbound_messages "
+                               "             WHERE processed_at IS NULL "
+                               "             OR (status = 'claimed' "
+                               "                 AND processed_at < now() - %s * interval '1 second') "
+                               "             ORDER BY id LIMIT %s "
+                               "             FOR UPDATE SKIP LOCKED) "
+                               "RETURNING id, from_phone, to_phone, body", [timeout, limit])
+                rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return sorted(rows)
+
+    @staticmethod
+    def finish(results):
+        """Record (id, status, recipient_id, corps_id) for processed messages in one statement"""
+        if not results:
+            return
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                extras.execute_values(cursor,
+                                      "UPDATE inbound_messages AS m "
+                                      "SET status = v.status, recipient_id = v.recipient_id, "
+                                      "corps_id = v.corps_id "
+                                      "FROM (VALUES %s) AS v (id, status, recipient_id, corps_id) "
+                                      "WHERE m.id = v.id",
+                                      results,
+                                      template="(%s, %s, %s::integer, %s::integer)",
+                                      page_size=len(results))
+        cursor.close()
+        conn.close()
+
+
+class PhoneLookups:
+    @staticmethod
+    def get(number, max_age_days):
+        """Return (valid, phone_number) for a recent lookup of number, or None"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT valid, phone_number FROM phone_lookups "
+                               "WHERE number = %s AND looked_up_at > now() - %s * interval '1 day'",
+                               [number, max_age_days])
+                lookup = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        return lookup
+
+    @staticmethod
+    def save(number, valid, phone_number):
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO phone_lookups (number, valid, phone_number) "
+                               "VALUES (%s, %s, %s) "
+                               "ON CONFLICT (number) DO UPDATE "
+                               "SET valid = EXCLUDED.valid, phone_number = EXCLUDED.phone_number, "
+                               "looked_up_at = now()",
+                               [number, valid, phone_number])
+        cursor.close()
+        conn.close()
+
+
+# Key for the advisory lock that stops two workers buying numbers at the same time
+provisioning_lock_id = 7201865
+
+
+class CorpsNumbers:
+    @staticmethod
+    def get(corps_id):
+        """The corps' sending numbers in E.164 form, oldest first"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT '+1' || phone FROM corps_numbers "
+                               "WHERE corps_id = %s ORDER BY created_at", [corps_id])
+                numbers = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        conn.close()
+        return numbers
+
+    @staticmethod
+    def get_corps(phone):
+        """The corps an E.164 sending number belongs to, or None"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT corps_id FROM corps_numbers WHERE phone = %s", [phone[2:]])
+                fetch = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        return fetch[0] if fetch else None
+
+    @staticmethod
+    def add(corps_id, phone):
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO corps_numbers (phone, corps_id) VALUES (%s, %s) "
+                               "ON CONFLICT DO NOTHING", [phone[2:], corps_id])
+                cursor.execute("UPDATE corps SET phone = %s WHERE id = %s AND phone IS NULL",
+                               [phone[2:], corps_id])
+        cursor.close()
+        conn.close()
+
+    @staticmethod
+    def loads(corps_id):
+        """{number: recipients assigned to it} for the corps' numbers"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT '+1' || n.phone, count(s.recipient_id) "
+                               "FROM corps_numbers n "
+                               "LEFT JOIN recipient_senders s ON s.phone = n.phone "
+                               "WHERE n.corps_id = %s "
+                               "GROUP BY n.phone", [corps_id])
+                loads = dict(cursor.fetchall())
+        cursor.close()
+        conn.close()
+        return loads
+
+    @staticmethod
+    def get_senders(recipient_ids):
+        """{recipient_id: E.164 number} for recipients that already have a sender"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT recipient_id, '+1' || phone FROM recipient_senders "
+                               "WHERE recipient_id = ANY(%s)", [list(recipient_ids)])
+                senders = dict(cursor.fetchall())
+        cursor.close()
+        conn.close()
+        return senders
+
+    @staticmethod
+    def set_senders(assignments):
+        """Store (recipient_id, E.164 number) pairs in one statement"""
+        if not assignments:
+            return
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                extras.execute_values(cursor,
+                                      "INSERT INTO recipient_senders (recipient_id, phone) VALUES %s "
+                                      "ON CONFLICT (recipient_id) DO UPDATE SET phone = EXCLUDED.phone",
+                                      [(recipient_id, phone[2:]) for recipient_id, phone in assignments],
+                                      page_size=len(assignments))
+        cursor.close()
+        conn.close()
+
+    @staticmethod
+    def shortfalls(recipients_per_number, min_numbers, max_numbers):
+        """(corps_id, corps name, area code, numbers needed) for corps that need more numbers
+
+        Only corps with an approved user count, so signing up and linking to a corps doesn't
+        buy anything by itself.
+        """
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT c.id, c.name, "
+                               "       (SELECT substring(u.phone, 1, 3) FROM users u "
+                               "        WHERE u.corps_id = c.id AND u.is_approved = 1 "
+                               "        AND u.phone IS NOT NULL LIMIT 1), "
+                               "       least(%s, greatest(%s, ceil((SELECT count(*) FROM recipients r "
+                               "                                   WHERE r.corps_id = c.id)::numeric / %s)::integer)) "
+                               "       - (SELECT count(*) FROM corps_numbers n WHERE n.corps_id = c.id) "
+                               "FROM corps c "
+                               "WHERE EXISTS (SELECT 1 FROM users u WHERE u.corps_id = c.id AND u.is_approved = 1)",
+                               [max_numbers, min_numbers, recipients_per_number])
+                rows = [row for row in cursor.fetchall() if row[3] > 0]
+        cursor.close()
+        conn.close()
+        return rows
+
+    @staticmethod
+    @contextmanager
+    def provisioning_lock():
+        """Yield True if this worker may provision numbers; the lock lasts for the block"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", [provisioning_lock_id])
+                yield cursor.fetchone()[0]
+
+
+class Suppressions:
+    @staticmethod
+    def set(corps_id, phone, reason, active=True):
+        """Add (or with active=False, lift) an opt-out for a number"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO suppressions (corps_id, phone, reason, active) "
+                               "VALUES (%s, %s, %s, %s) "
+                               "ON CONFLICT (corps_id, phone) DO UPDATE "
+                               "SET reason = EXCLUDED.reason, active = EXCLUDED.active, "
+                               "updated_at = clock_timestamp()",
+                               [corps_id, phone, reason, active])
+        cursor.close()
+        conn.close()
+
+    @staticmethod
+    def changed_since(since):
+        """(corps_id, phone, active, updated_at) for every entry changed after since"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                if since is None:
+                    cursor.execute("SELECT corps_id, phone, active, updated_at FROM suppressions "
+                                   "WHERE active")
+                else:
+                    # Overlap the window a little so rows committed late aren't missed
+                    cursor.execute("SELECT corps_id, phone, active, updated_at FROM suppressions "
+                                   "WHERE updated_at > %s - interval '1 minute'", [since])
+                rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return rows
+
+
+class ScheduledMessages:
+    @staticmethod
+    def create(user_id, corps_id, group_ids, everyone, message, run_at, every=None, spread=0):
+        """Schedule a message for run_at, repeating every ``every`` (a timedelta) if given"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO scheduled_messages "
+                               "(user_id, corps_id, group_ids, everyone, message, next_run, every, spread) "
+                               "VALUES (%s, %s, %s, %s, %s, %s, %s, %s) "
+                               "RETURNING id",
+                               [user_id, corps_id, [int(group_id) for group_id in group_ids], everyone,
+                                message, run_at, every, spread])
+                schedule_id = cursor.fetchone()[0]
+        cursor.close()
+        conn.close()
+        return schedule_id
+
+    @staticmethod
+    def get_by_corps(corps_id):
+        """Pending schedules for a corps as (id, user_id, group_ids, everyone, message, next_run,
+        every, spread, last_job) rows, soonest first"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT id, user_id, group_ids, everyone, message, next_run, every, spread, last_job "
+                               "FROM scheduled_messages "
+                               "WHERE corps_id = %s AND active "
+                               "ORDER BY next_run", [corps_id])
+                schedules = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return schedules
+
+    @staticmethod
+    def cancel(schedule_id, corps_id):
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE scheduled_messages SET active = false "
+                               "WHERE id = %s AND corps_id = %s", [schedule_id, corps_id])
+                cancelled = cursor.rowcount
+        cursor.close()
+        conn.close()
+        return cancelled > 0
+
+    @staticmethod
+    def claim_due(limit, timezone):
+        """Claim up to limit due schedules and move them to their next run
+
+        Rows another worker is claiming are skipped rather than waited for, and claiming
+        advances next_run (or deactivates one-off schedules) in the same statement, so a
+        schedule is only ever handed to one worker per run.  Runs missed while nothing was
+        polling are skipped, not caught up.  The next run is worked out on the wall clock
+        of timezone, so a 9 AM reminder stays at 9 AM across DST changes.  Returns (id,
+        user_id, corps_id, group_ids, everyone, message, spread) rows.
+        """
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE scheduled_messages s "
+                               "SET next_run = CASE WHEN s.every IS NULL THEN s.next_run "
+                               "    ELSE ((s.next_run AT TIME ZONE %(tz)s) "
+                               "          + s.every * (floor(extract(epoch FROM (now() AT TIME ZONE %(tz)s) "
+                               "                                               - (s.next_run AT TIME ZONE %(tz)s)) "
+                               "                             / extract(epoch FROM s.every)) + 1)) "
+                               "         AT TIME ZONE %(tz)s END, "
+                               "    active = s.every IS NOT NULL, "
+                               "    last_run = now() "
+                               "WHERE s.id IN (SELECT id FROM scheduled_messages "
+                               "               WHERE active AND next_run <= now() "
+                               "               ORDER BY next_run "
+                               "               LIMIT %(limit)s "
+                               "               FOR UPDATE SKIP LOCKED) "
+                               "RETURNING s.id, s.user_id, s.corps_id, s.group_ids, s.everyone, s.message, s.spread",
+                               {"tz": timezone, "limit": limit})
+                rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return rows
+
+    @staticmethod
+    def record_run(schedule_id, job_id):
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE scheduled_messages SET last_job = %s WHERE id = %s", [job_id, schedule_id])
+        cursor.close()
+        conn.close()
+
+
+class SendJobs:
+    @staticmethod
+    def create(user_id, group_id, message, total, suppressed=0):
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO send_jobs "
+                               "(user_id, group_id, message, status, total, suppressed) "
+                               "VALUES (%s, %s, %s, 'queued', %s, %s) "
+                               "RETURNING id", [user_id, group_id, message, total, suppressed])
+                job_id = cursor.fetchone()[0]
+        cursor.close()
+        conn.close()
+        return job_id
+
+    @staticmethod
+    def update(job_id, status, sent, failed):
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE send_jobs "
+                               "SET status = %s, sent = %s, failed = %s, heartbeat_at = now(), "
+                               "finished_at = CASE WHEN %s IN ('done', 'failed') THEN now() END "
+                               "WHERE id = %s",
+                               [status, sent, failed, status, job_id])
+        cursor.close()
+        conn.close()
+
+    @staticmethod
+    def touch(job_ids):
+        """Mark jobs as still being worked on"""
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE send_jobs SET heartbeat_at = now() WHERE id = ANY(%s)", [list(job_ids)])
+        cursor.close()
+        conn.close()
+
+    @staticmethod
+    def fail_orphans(stale):
+        """Fail unfinished jobs nobody has touched for stale seconds; returns (id, total, sent, failed) rows
+
+        Their worker stopped (a restart, or gunicorn recycling it) before the job finished.
+        """
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE send_jobs SET status = 'failed', finished_at = now() "
+                               "WHERE status IN ('queued', 'sending') "
+                               "AND heartbeat_at < now() - %s * interval '1 second' "
+                               "RETURNING id, total, sent, failed", [stale])
+                orphans = cursor.fetchall()
+        cursor.close()
+        conn.close()
+        return orphans
+
+    @staticmethod
+    def get(job_id):
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT id, user_id, group_id, status, total, sent, failed, suppressed "
+                               "FROM send_jobs WHERE id = %s", [job_id])
+                job = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        if not job:
+            return None
+        return {"id": job[0],
+                "user_id": job[1],
+                "group_id": job[2],
+                "status": job[3],
+                "total": job[4],
+                "sent": job[5],
+                "failed": job[6],
+                "suppressed": job[7]}
+
+
+class SenderPacing:
+    @staticmethod
+    def reserve(sender, interval, burst):
+        """Take the sender's next send slot, shared by every worker, and return the seconds to wait
+
+        Each sender keeps a theoretical arrival time (tat) that moves forward by interval
+        per message, so a sender with bursts of up to burst messages averages one message
+        per interval however many workers are sending from it.
+        """
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO sender_pacing AS p (sender, tat) "
+                               "VALUES (%(sender)s, clock_timestamp() + %(interval)s * interval '1 second') "
+                               "ON CONFLICT (sender) DO UPDATE "
+                               "SET tat = greatest(p.tat, clock_timestamp()) + %(interval)s * interval '1 second' "
+                               "RETURNING greatest(0, extract(epoch FROM p.tat - clock_timestamp()) "
+                               "                      - %(interval)s * %(burst)s)",
+                               {"sender": sender, "interval": interval, "burst": burst})
+                wait = float(cursor.fetchone()[0])
+        cursor.close()
+        conn.close()
+        return wait
+
+
+# Per-method latency histograms when metrics are enabled (see metrics.py)
+for _cls in (User, GroupIndex, Recipients, Messages, Inbound, PhoneLookups, CorpsNumbers, Suppressions,
+             ScheduledMessages, SendJobs, SenderPacing):
+    metrics.instrument(_cls)
@@ -0,0 +1,98 @@
+import json
+import os
+import re
+import threading
+import time
+import requests
+from loguru import logger
+
+max_age_re = re.compile(r"max-age=(\d+)")
+
+
+class DiscoveryCache:
+    """Keeps an OpenID discovery document in memory and on disk
+
+    The document is refreshed by a background thread shortly before its Cache-Control
+    max-age runs out.  If a refresh fails the old document keeps being served, so logins
+    only ever fetch it themselves when a worker starts with neither copy available.
+    """
+    def __init__(self, url, path, session=requests, default_max_age=3600, retry_after=60):
+        self.url = url
+        self.session = session
+        self.path = path
+        self.default_max_age = default_max_age
+        self.retry_after = retry_after
+        self._config = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def get(self):
+        """Return the discovery document without touching the network when possible"""
+        self._start()
+        if self._config is None:
+            with self._lock:
+                if self._config is None and not self._load():
+                    self.refresh()
+        return self._config
+
+    def refresh(self):
+        """Fetch the document now; returns False and keeps the old copy on failure"""
+        try:
+            response = self.session.get(self.url, timeout=10)
+            response.raise_for_status()
+            config = response.json()
+        except (requests.RequestException, ValueError):
+            if self._config is None:
+                raise
+            logger.warning(f"Could not refresh {self.url}; serving the cached copy")
+            return False
+        match = max_age_re.search(response.headers.get("Cache-Control", ""))
+        max_age = int(match.group(1)) if match else self.default_max_age
+        self._config = config
+        self._expires = time.time() + max_age
+        self._save()
+        return True
+
+    def _start(self):
+        # Threads don't survive a fork, so each worker starts its own refresher
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._refresher, name="discovery-refresh", daemon=True).start()
+
+    def _refresher(self):
+        while True:
+            if self._config is None:
+                with self._lock:
+                    if self._config is None:
+                        self._load()
+            # Refresh a little before expiry so requests never see an expired document
+            wait = max(0, (self._expires - time.time()) * 0.9)
+            time.sleep(wait)
+            try:
+                if not self.refresh():
+                    time.sleep(self.retry_after)
+            except (requests.RequestException, ValueError):
+                logger.warning(f"Could not fetch {self.url}; retrying in {self.retry_after} seconds")
+                time.sleep(self.retry_after)
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self._config = cached["config"]
+        self._expires = cached["expires"]
+        return True
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"expires": self._expires, "config": self._config}, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logger.warning(f"Could not save {self.url} to {self.path}")
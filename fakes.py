@@ -0,0 +1,350 @@
+"""Local stand-ins for Twilio and the send_jobs/messages tables
+
+These let the send pipeline run without a network or database, e.g.
+
+    queue = SendQueue(client=FakeTwilioClient(), jobs=FakeJobStore(), messages=FakeMessageLog(),
+                      suppressions=FakeSuppressionList())
+
+FakeServices goes one level lower: it is an HTTP server that answers for Twilio, Google
+sign-in and the Discord webhook, so the real clients can be used against it.
+"""
+import itertools
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from requests.adapters import HTTPAdapter
+from twilio.base.exceptions import TwilioRestException
+
+
+class FakeMessage:
+    def __init__(self, to, from_, body):
+        self.sid = f"SM{uuid.uuid4().hex}"
+        self.to = to
+        self.from_ = from_
+        self.body = body
+        self.status = "queued"
+
+
+class FakeClock:
+    """Simulated clock for SendScheduler; sleep() just moves time forward"""
+    def __init__(self, start=0.0):
+        self.now = start
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += seconds
+
+
+class FakeMessageList:
+    def __init__(self, latency=0, fail_numbers=(), rate_limited=0, unsubscribed=()):
+        self.latency = latency
+        self.fail_numbers = set(fail_numbers)
+        self.unsubscribed = set(unsubscribed)
+        self.rate_limited = rate_limited
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def create(self, to, from_=None, body=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.rate_limited > 0:
+                self.rate_limited -= 1
+                raise TwilioRestException(429, "/Messages.json", msg="Too Many Requests", code=20429)
+        if to in self.fail_numbers:
+            raise TwilioRestException(400, "/Messages.json", msg=f"Invalid 'To' number {to}", code=21211)
+        if to in self.unsubscribed:
+            raise TwilioRestException(400, "/Messages.json", msg=f"{to} is unsubscribed", code=21610)
+        msg = FakeMessage(to, from_ or kwargs.get("messaging_service_sid"), body)
+        with self._lock:
+            self.sent.append(msg)
+        return msg
+
+
+class FakeNotification:
+    def __init__(self):
+        self.sid = f"NT{uuid.uuid4().hex}"
+
+
+class FakeNotificationList:
+    def __init__(self, sent):
+        self.sent = sent
+
+    def create(self, to_binding=(), body=None, **kwargs):
+        notification = FakeNotification()
+        for binding in to_binding:
+            self.sent.append((notification.sid, json.loads(binding)["address"], body))
+        return notification
+
+
+class FakeNotifyService:
+    def __init__(self, sent):
+        self.notifications = FakeNotificationList(sent)
+
+
+class FakeNotify:
+    """Mimics client.notify.v1.services(sid).notifications.create"""
+    def __init__(self):
+        self.sent = []
+        self.v1 = self
+
+    def services(self, sid):
+        return FakeNotifyService(self.sent)
+
+
+class FakeTwilioClient:
+    """Mimics the parts of twilio.rest.Client the app uses to send messages"""
+    def __init__(self, latency=0, fail_numbers=(), rate_limited=0, unsubscribed=()):
+        self.messages = FakeMessageList(latency, fail_numbers, rate_limited, unsubscribed)
+        self.notify = FakeNotify()
+
+
+class FakeJobStore:
+    """In-memory version of db.SendJobs"""
+    def __init__(self):
+        self.jobs = {}
+        self._ids = itertools.count(1)
+
+    def create(self, user_id, group_id, message, total, suppressed=0):
+        job_id = next(self._ids)
+        self.jobs[job_id] = {"id": job_id,
+                             "user_id": user_id,
+                             "group_id": group_id,
+                             "status": "queued",
+                             "total": total,
+                             "sent": 0,
+                             "failed": 0,
+                             "suppressed": suppressed}
+        return job_id
+
+    def update(self, job_id, status, sent, failed):
+        self.jobs[job_id].update(status=status, sent=sent, failed=failed)
+
+    def touch(self, job_ids):
+        pass
+
+    def fail_orphans(self, stale):
+        return []
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+
+class FakeMessageLog:
+    """In-memory version of db.Messages"""
+    def __init__(self):
+        self.rows = []
+        self.writes = 0
+
+    def add_message(self, sid, user_id, recipient_id, group_id, message):
+        self.add_messages([(sid, user_id, recipient_id, group_id, message)])
+
+    def add_messages(self, rows):
+        self.rows.extend(rows)
+        self.writes += 1
+
+
+class FakeSuppressionList:
+    """In-memory version of suppression.SuppressionList"""
+    def __init__(self, entries=()):
+        self.entries = set(entries)
+
+    def add(self, corps_id, phone, reason):
+        self.entries.add((corps_id, phone))
+
+    def remove(self, corps_id, phone):
+        self.entries.discard((corps_id, phone))
+
+    def filter(self, corps_id, recipients, count=True):
+        allowed = [recipient for recipient in recipients if (corps_id, recipient[1]) not in self.entries]
+        return allowed, len(recipients) - len(allowed)
+
+
+class FakeNumberPool:
+    """In-memory version of numberpool.NumberPool that hands out numbers round robin"""
+    def __init__(self, numbers=None):
+        self.pools = numbers or {}
+        self.assigned = {}
+
+    def numbers(self, corps_id):
+        return self.pools.get(corps_id, [])
+
+    def corps_for_number(self, phone):
+        for corps_id, numbers in self.pools.items():
+            if phone in numbers:
+                return corps_id
+        return None
+
+    def senders_for(self, corps_id, recipient_ids):
+        numbers = self.numbers(corps_id)
+        if not numbers:
+            return {}
+        for recipient_id in recipient_ids:
+            if recipient_id not in self.assigned:
+                self.assigned[recipient_id] = numbers[len(self.assigned) % len(numbers)]
+        return {recipient_id: self.assigned[recipient_id] for recipient_id in recipient_ids}
+
+
+class _Rerouted(HTTPAdapter):
+    """Sends https://<host>/<path> to <base>/<host>/<path> instead"""
+    def __init__(self, base, **kwargs):
+        self.base = base
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = f"{self.base}/{parts.hostname}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+        return super().send(request, **kwargs)
+
+
+class FakeServices:
+    """HTTP stand-in for the Twilio REST API, Google sign-in and the Discord webhook
+
+    route(session) points a requests session (e.g. ``config.http.session``) at this server
+    for all of those hosts, so the real Twilio client, the OAuth callback and the Discord
+    logger run unchanged.  Every call waits ``latency`` seconds, every ``rate_limit_every``th
+    message create gets a 429, and lookups of ``invalid_numbers`` get a 404.
+
+    Signing in with Google as ``code=<sub>`` returns a verified profile for user <sub>.
+    """
+    HOSTS = ("api.twilio.com", "lookups.twilio.com", "notify.twilio.com",
+             "accounts.google.com", "oauth2.googleapis.com", "openidconnect.googleapis.com",
+             "discord.com", "discordapp.com")
+
+    def __init__(self, latency=0, rate_limit_every=0, invalid_numbers=()):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.invalid_numbers = set(invalid_numbers)
+        self.counts = Counter()
+        self.messages = []
+        self._creates = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        services = self
+
+        class Handler(_FakeServiceHandler):
+            owner = services
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-services", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def route(self, session):
+        """Mount an adapter on session that sends every faked host here, keeping its retries"""
+        adapter = _Rerouted(self.url, pool_maxsize=32, max_retries=session.get_adapter("https://").max_retries)
+        for host in self.HOSTS:
+            session.mount(f"https://{host}/", adapter)
+
+    def handle(self, method, host, path, form, headers):
+        """Return (status, JSON body) for one request"""
+        if self.latency:
+            time.sleep(self.latency)
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if host == "api.twilio.com" and path.endswith("/Messages.json") and method == "POST":
+            return self._create_message(form)
+        if host == "api.twilio.com" and "/AvailablePhoneNumbers/" in path:
+            self.counts["twilio_number_search"] += 1
+            number = f"+1555{next(self._creates) % 10_000_000:07d}"
+            return 200, {"available_phone_numbers": [{"phone_number": number, "friendly_name": number}],
+                         "uri": path}
+        if host == "api.twilio.com" and path.endswith("/IncomingPhoneNumbers.json") and method == "POST":
+            self.counts["twilio_number_buy"] += 1
+            return 201, {"sid": f"PN{uuid.uuid4().hex}", "phone_number": form.get("PhoneNumber")}
+        if host == "lookups.twilio.com" and len(parts) == 3 and parts[1] == "PhoneNumbers":
+            self.counts["twilio_lookup"] += 1
+            if parts[2] in self.invalid_numbers:
+                return 404, _twilio_error(404, 20404, "The requested resource was not found")
+            return 200, {"phone_number": parts[2], "country_code": "US", "national_format": parts[2],
+                         "url": f"https://lookups.twilio.com{path}"}
+        if host == "notify.twilio.com" and path.endswith("/Notifications") and method == "POST":
+            self.counts["twilio_notify"] += 1
+            return 201, {"sid": f"NT{uuid.uuid4().hex}"}
+        if host == "accounts.google.com" and path == "/.well-known/openid-configuration":
+            self.counts["google_discovery"] += 1
+            return 200, {"issuer": "https://accounts.google.com",
+                         "authorization_endpoint": "https://accounts.google.com/o/oauth2/v2/auth",
+                         "token_endpoint": "https://oauth2.googleapis.com/token",
+                         "userinfo_endpoint": "https://openidconnect.googleapis.com/v1/userinfo"}
+        if host == "oauth2.googleapis.com" and path == "/token":
+            self.counts["google_token"] += 1
+            return 200, {"access_token": f"token-{form.get('code')}", "token_type": "Bearer",
+                         "expires_in": 3599, "scope": "openid email profile"}
+        if host == "openidconnect.googleapis.com" and path == "/v1/userinfo":
+            self.counts["google_userinfo"] += 1
+            sub = headers.get("Authorization", "").rpartition("token-")[2]
+            if not sub:
+                return 401, {"error": "invalid_request"}
+            return 200, {"sub": sub, "email": f"{sub}@example.org", "email_verified": True,
+                         "picture": "https://example.org/avatar.png", "given_name": f"User {sub}"}
+        if host in ("discord.com", "discordapp.com") and "/webhooks/" in path:
+            self.counts["discord_webhook"] += 1
+            return 204, None
+        self.counts["not_found"] += 1
+        return 404, _twilio_error(404, 20404, f"No fake for {method} {host}{path}")
+
+    def _create_message(self, form):
+        if self.rate_limit_every and next(self._creates) % self.rate_limit_every == 0:
+            self.counts["twilio_rate_limited"] += 1
+            return 429, _twilio_error(429, 20429, "Too Many Requests")
+        self.counts["twilio_message_create"] += 1
+        to = form.get("To")
+        if to in self.invalid_numbers:
+            return 400, _twilio_error(400, 21211, f"Invalid 'To' Phone Number: {to}")
+        message = {"sid": f"SM{uuid.uuid4().hex}", "to": to, "from": form.get("From"),
+                   "messaging_service_sid": form.get("MessagingServiceSid"), "body": form.get("Body"),
+                   "status": "queued", "num_segments": "1", "direction": "outbound-api"}
+        with self._lock:
+            self.messages.append(message)
+        return 201, message
+
+
+def _twilio_error(status, code, message):
+    return {"status": status, "code": code, "message": message,
+            "more_info": f"https://www.twilio.com/docs/errors/{code}"}
+
+
+class _FakeServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; without this each keep-alive reply waits on a delayed ACK
+    disable_nagle_algorithm = True
+    owner = None
+
+    def _respond(self):
+        host, _, path = self.path.lstrip("/").partition("/")
+        path, _, query = f"/{path}".partition("?")
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length).decode() if length else query
+        form = {key: values[-1] for key, values in parse_qs(raw).items()}
+        status, body = self.owner.handle(self.command, host, path, form, self.headers)
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        if payload:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_DELETE = _respond
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,26 @@
+# gunicorn -c gunicorn.conf.py "launcher:create_app()"
+#
+# The app is imported once in the master and forked, which is safe because nothing opens a
+# connection or starts a thread at import; each worker sets those up after the fork.
+preload_app = True
+
+
+def post_fork(server, worker):
+    from launcher import start_worker
+    start_worker()
+
+
+# Every worker writes its metrics to metrics.dir and /metrics adds them up (see metrics.py)
+def on_starting(server):
+    from metrics import metrics
+    metrics.reset()
+
+
+def worker_exit(server, worker):
+    from metrics import metrics
+    metrics.flush()
+
+
+def child_exit(server, worker):
+    from metrics import metrics
+    metrics.archive(worker.pid)
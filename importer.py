@@ -0,0 +1,130 @@
+import csv
+import io
+from loguru import logger
+from config import settings
+from db import Recipients, User
+from jobs import send_queue
+from phones import normalize
+from utils import welcome_recipients_body
+
+# Only this many row errors are kept for the report; the rest are just counted
+max_errors = 200
+# Largest file accepted, in recipients; every new one can be sent a (paid) welcome text
+max_rows = settings.get("import", {}).get("max_rows", 5000)
+
+
+class TooManyRows(Exception):
+    pass
+
+
+class CsvSource:
+    """File-like object that feeds rows to COPY as CSV, a few at a time"""
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+            self._pending += self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        if size < 0:
+            size = len(self._pending)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.invalid = 0
+        self.duplicates = 0
+        self.added = 0
+        self.existing = 0
+        self.welcome_job = None
+        self.errors = []
+
+    def error(self, line, message):
+        self.invalid += 1
+        if len(self.errors) < max_errors:
+            self.errors.append((line, message))
+
+
+def read_rows(stream, report):
+    """Yield (line, name, phone, groups) for each usable row of an uploaded CSV
+
+    The file needs name and phone columns and may have a groups column of group names
+    separated by ';'.  Bad rows and numbers repeated within the file are recorded on the
+    report instead of being yielded.  A file with more than ``max_rows`` rows raises
+    TooManyRows.
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    fields = {(field or "").strip().lower(): field for field in reader.fieldnames or []}
+    if "name" not in fields or "phone" not in fields:
+        report.error(1, "The file needs a header row with name and phone columns")
+        return
+    seen = {}
+    for row in reader:
+        report.rows += 1
+        if report.rows > max_rows:
+            raise TooManyRows()
+        line = reader.line_num
+        name = (row.get(fields["name"]) or "").strip()
+        phone = normalize(row.get(fields["phone"]))
+        if not name:
+            report.error(line, "Missing name")
+            continue
+        if phone is None:
+            report.error(line, f"{row.get(fields['phone'])!r} is not a valid US phone number")
+            continue
+        phone = phone[2:]
+        if phone in seen:
+            report.duplicates += 1
+            if len(report.errors) < max_errors:
+                report.errors.append((line, f"Same phone as line {seen[phone]}; skipped"))
+            continue
+        seen[phone] = line
+        groups = ";".join(g.strip() for g in (row.get(fields.get("groups")) or "").split(";") if g.strip())
+        yield line, name, phone, groups
+
+
+def import_recipients(stream, corps_id, group_ids, welcome=True):
+    """Import an uploaded CSV of recipients into a corps and return an ImportReport
+
+    New recipients get the welcome text through the paced send queue.
+    """
+    report = ImportReport()
+    try:
+        added, existing = Recipients.import_rows(corps_id, CsvSource(read_rows(stream, report)), group_ids)
+    except UnicodeDecodeError:
+        # The whole import is one transaction, so nothing from the file was kept
+        report.error("", "The file isn't UTF-8 text. In Excel, save it as \"CSV UTF-8\" and import it again.")
+        logger.info(f"Rejected a recipient import for corps {corps_id} that isn't UTF-8")
+        return report
+    except TooManyRows:
+        report.error("", f"The file has more than {max_rows} recipients. Split it into smaller files and "
+                         f"import each one; nothing was imported.")
+        logger.info(f"Rejected a recipient import for corps {corps_id} with more than {max_rows} rows")
+        return report
+    except csv.Error as e:
+        report.error(report.rows + 2, f"The file couldn't be read as CSV ({e}); nothing was imported.")
+        logger.info(f"Rejected a recipient import for corps {corps_id}: {e}")
+        return report
+    report.added = len(added)
+    report.existing = existing
+    if welcome and added:
+        corps_phone = User.get_corps_phone(corps_id)
+        recipients = [(name, f"+1{phone}", recipient_id, 0) for recipient_id, name, phone in added]
+        job = send_queue.submit("WELCOME", 0, corps_phone, welcome_recipients_body, recipients,
+                                corps_id=corps_id)
+        report.welcome_job = job.id
+    logger.info(f"Imported {report.added} recipients into corps {corps_id} "
+                f"({report.existing} already present, {report.invalid} invalid, "
+                f"{report.duplicates} repeated)")
+    return report
@@ -0,0 +1,235 @@
+import atexit
+import os
+import threading
+from loguru import logger
+from twilio.request_validator import RequestValidator
+from config import settings
+from db import Inbound, Recipients, User, Messages
+from jobs import send_queue
+from templating import MessageTemplate
+from suppression import suppressions
+from numberpool import number_pool
+
+STOP_WORDS = {"STOP", "STOPALL", "UNSUBSCRIBE", "CANCEL", "END", "QUIT"}
+START_WORDS = {"START", "YES", "UNSTOP"}
+HELP_WORDS = {"HELP", "INFO"}
+# Order in which a message moves through Twilio's statuses; later ones win
+STATUS_RANK = {"accepted": 0, "queued": 1, "sending": 2, "sent": 3,
+               "delivered": 4, "undelivered": 4, "failed": 4, "read": 5}
+
+validator = RequestValidator(settings["twilio"]["token"])
+
+
+def valid_signature(url, params, signature):
+    """Check that a webhook really came from Twilio"""
+    if not settings.get("inbound", {}).get("validate", True):
+        return True
+    return validator.validate(url, params, signature)
+
+
+def keyword(body):
+    """The opt-out/opt-in/help keyword a message consists of, if any"""
+    word = (body or "").strip().strip(".!").upper()
+    if word in STOP_WORDS:
+        return "STOP"
+    if word in START_WORDS:
+        return "START"
+    if word in HELP_WORDS:
+        return "HELP"
+    return None
+
+
+def error_number(error_code):
+    """A callback's ErrorCode as an int, or None when it's missing or not a number"""
+    try:
+        return int(error_code)
+    except (TypeError, ValueError):
+        return None
+
+
+class InboundProcessor:
+    """Works through stored inbound messages in the background
+
+    The /sms webhook only stores the message and wakes this thread.  Messages are claimed
+    from inbound_messages in batches, matched to a recipient by phone number, and either
+    treated as a STOP/START/HELP keyword or forwarded to the corps' approved users.  Each
+    worker runs one processor, and also polls every ``poll_interval`` seconds to pick up
+    anything stored by other workers.  A message that fails to be handled is recorded with
+    status "error"; one claimed by a worker that died before finishing its batch is claimed
+    again after ``claim_timeout`` seconds.
+
+    Forwards and HELP replies go out through the send queue once the batch has been
+    recorded, so the batch never waits on Twilio or on pacing.
+    """
+    def __init__(self, batch_size=None, poll_interval=None):
+        cfg = settings.get("inbound", {})
+        self.batch_size = batch_size or cfg.get("batch_size", 100)
+        self.poll_interval = poll_interval or cfg.get("poll_interval", 5)
+        self.claim_timeout = cfg.get("claim_timeout", 300)
+        self.help_text = cfg.get("help_text")
+        self.processed = 0
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def wake(self):
+        self._start()
+        self._wake.set()
+
+    def _start(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._run, name="inbound-sms", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                while self.process_batch() == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception("Inbound message processing failed")
+
+    def process_batch(self):
+        """Claim and handle one batch; returns how many messages were claimed"""
+        rows = Inbound.claim(self.batch_size, self.claim_timeout)
+        if not rows:
+            return 0
+        matches = Recipients.get_by_phones({from_phone[2:] for _, from_phone, _, _ in rows})
+        results = []
+        replies = []
+        contacts = {}
+        for inbound_id, from_phone, to_phone, body in rows:
+            recipient = self.match(matches.get(from_phone[2:], []), to_phone)
+            try:
+                status = self.handle(recipient, from_phone, to_phone, body, replies, contacts)
+            except Exception:
+                # One bad message (or a database hiccup) mustn't strand the rest of the batch
+                logger.exception(f"Could not handle inbound message {inbound_id} from {from_phone}: {body}")
+                status = "error"
+            results.append((inbound_id, status,
+                            recipient[0] if recipient else None,
+                            recipient[2] if recipient else None))
+        # The batch is finished before anything is sent, so however long the sends take, no
+        # other worker can reclaim these messages and answer them a second time
+        Inbound.finish(results)
+        for reply in replies:
+            try:
+                send_queue.submit(*reply)
+            except Exception:
+                logger.exception(f"Could not queue a reply from {reply[2]}")
+        self.processed += len(rows)
+        return len(rows)
+
+    @staticmethod
+    def match(candidates, to_phone):
+        """Pick the recipient record for the corps whose number was texted"""
+        corps_id = number_pool.corps_for_number(to_phone) if len(candidates) > 1 else None
+        for candidate in candidates:
+            if candidate[2] == corps_id:
+                return candidate
+        return candidates[0] if candidates else None
+
+    def handle(self, recipient, from_phone, to_phone, body, replies, contacts):
+        """Act on one message and return its status; texts to send are added to replies
+
+        Each reply is the arguments for SendQueue.submit, sent from the number that was texted.
+        """
+        word = keyword(body)
+        if word == "STOP":
+            # Twilio confirms opt-outs itself; we just stop sending to the number
+            if recipient:
+                suppressions.add(recipient[2], from_phone, "STOP")
+            return "stop"
+        if word == "START":
+            if recipient:
+                suppressions.remove(recipient[2], from_phone)
+            return "start"
+        if word == "HELP":
+            if self.help_text:
+                name, recipient_id = (recipient[1], recipient[0]) if recipient else ("", 0)
+                replies.append(("HELP", 0, to_phone, MessageTemplate(self.help_text, literal=True),
+                                [(name, from_phone, recipient_id)]))
+            return "help"
+        if not recipient:
+            logger.debug(f"Message from unknown number {from_phone}")
+            return "unmatched"
+        recipient_id, name, corps_id = recipient
+        if corps_id not in contacts:
+            contacts[corps_id] = User.get_corps_contacts(corps_id)
+        if contacts[corps_id]:
+            forward = MessageTemplate(f"Reply from {name}: {body}", literal=True)
+            replies.append(("REPLY", 0, to_phone, forward,
+                            [(name, phone, recipient_id) for phone in contacts[corps_id]]))
+        return "forwarded"
+
+    def stats(self):
+        return {"processed": self.processed}
+
+
+inbound_processor = InboundProcessor()
+
+
+class StatusBuffer:
+    """Collects delivery status callbacks and applies them in batched UPDATEs
+
+    Callbacks for the same sid are folded together, keeping the most advanced status, and
+    the buffer is written with Messages.update_statuses when ``max_rows`` sids are waiting
+    or ``max_wait`` seconds after the first one arrived.
+    """
+    def __init__(self, writer=None, max_rows=None, max_wait=None):
+        cfg = settings.get("status_callbacks", {})
+        self.writer = writer or Messages.update_statuses
+        self.max_rows = max_rows or cfg.get("max_rows", 500)
+        self.max_wait = max_wait or cfg.get("max_wait", 2.0)
+        self.received = 0
+        self.written = 0
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, sid, status, error_code=None):
+        if not sid or status not in STATUS_RANK:
+            return
+        with self._lock:
+            self.received += 1
+            current = self._pending.get(sid)
+            if current is None or STATUS_RANK[status] >= STATUS_RANK[current[0]]:
+                self._pending[sid] = (status, error_number(error_code))
+            full = len(self._pending) >= self.max_rows
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.max_wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            rows = [(sid, status, error_code) for sid, (status, error_code) in pending.items()]
+            try:
+                self.writer(rows)
+                self.written += len(rows)
+            except Exception:
+                logger.exception(f"Failed to write {len(rows)} message statuses")
+                for sid, status in pending.items():
+                    self._pending.setdefault(sid, status)
+
+    def stats(self):
+        return {"received": self.received,
+                "written": self.written,
+                "pending": len(self._pending)}
+
+
+status_buffer = StatusBuffer()
+atexit.register(status_buffer.flush)
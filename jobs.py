@@ -0,0 +1,319 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from loguru import logger
+from twilio.base.exceptions import TwilioRestException
+from config import settings, twilio
+from db import SendJobs, Messages, MessageLog, SenderPacing
+from pacing import SendScheduler
+from utils import status_callback
+from suppression import suppressions as suppression_list
+from numberpool import number_pool
+from templating import MessageTemplate
+
+# Twilio error for a number that has replied STOP to the sender
+UNSUBSCRIBED = 21610
+
+
+class SendJob:
+    """A single group message being sent in the background"""
+    def __init__(self, id_, user_id, group_id, from_phone, message, recipients, corps_id=None, suppressed=0,
+                 spread=0):
+        self.id = id_
+        self.user_id = user_id
+        self.group_id = group_id
+        self.corps_id = corps_id
+        self.from_phone = from_phone
+        self.template = message if isinstance(message, MessageTemplate) else MessageTemplate(message)
+        self.message = self.template.text
+        self.recipients = recipients
+        self.total = len(recipients)
+        self.suppressed = suppressed
+        self.spread = spread
+        self.status = "queued"
+        self.sent = 0
+        self.failed = 0
+        self.names = []
+        self.senders = {}
+        self.done_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def record_sent(self, name):
+        with self._lock:
+            self.sent += 1
+            self.names.append(name)
+            return self.sent + self.failed
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+            return self.sent + self.failed
+
+    def to_dict(self):
+        return {"id": self.id,
+                "user_id": self.user_id,
+                "group_id": self.group_id,
+                "status": self.status,
+                "total": self.total,
+                "sent": self.sent,
+                "failed": self.failed,
+                "suppressed": self.suppressed}
+
+
+class SendQueue:
+    """Runs send jobs on a worker pool so the request can return right away
+
+    Jobs are processed ``max_jobs`` at a time and the Twilio calls for all running jobs
+    share a pool of ``concurrency`` threads, paced per sending number by a SendScheduler.
+    Progress is written to the send_jobs table
+    every ``progress_every`` messages so any worker can answer a status poll, and the
+    message rows for a job are written in batches through a MessageLog.
+
+    A corps can be given a Twilio Messaging Service (``twilio.messaging_services``) to send
+    through instead of its own number, or a Notify service (``twilio.notify_services``) so
+    that sends of ``bulk_min`` or more recipients go out ``bulk_chunk`` numbers per API call.
+
+    Otherwise each recipient is texted from their own number out of the corps' pool (see
+    numberpool.NumberPool), falling back to ``from_phone``.
+
+    Numbers on the corps' suppression list are dropped before sending and only counted.
+
+    Messages can use ``{name}`` fields (see templating.MessageTemplate); those are rendered
+    per recipient and never go through Notify, which sends one body to everyone.
+
+    A job submitted with ``spread`` starts its messages evenly over that many seconds instead
+    of as fast as pacing allows, to keep large scheduled broadcasts out of peak hours.  Such
+    jobs mostly wait, for up to hours, so they run on their own ``max_spread_jobs`` threads
+    and never hold up the ``max_jobs`` slots that interactive sends use.
+
+    Jobs only live in the memory of the worker running them, so once start() has been called
+    that worker marks its jobs alive every ``heartbeat`` seconds.  A job left queued or
+    sending by a worker that stopped (a restart, or gunicorn recycling it mid-spread) goes
+    quiet, and after ``orphan_after`` seconds any worker marks it failed.  It isn't resumed,
+    since which of its in-flight messages went out is unknown.
+    """
+    def __init__(self, client=None, jobs=SendJobs, messages=Messages,
+                 concurrency=None, max_jobs=None, progress_every=None, scheduler=None,
+                 suppressions=None, numbers=None):
+        cfg = settings.get("send", {})
+        self.client = client or twilio
+        self.scheduler = scheduler or SendScheduler(self.client,
+                                                    rate=cfg.get("rate", 1.0),
+                                                    burst=cfg.get("burst", 1),
+                                                    rates=cfg.get("rates"),
+                                                    retries=cfg.get("retries", 4),
+                                                    status_callback=status_callback,
+                                                    shared=SenderPacing if cfg.get("shared_pacing", False) else None)
+        self.jobs = jobs
+        self.messages = messages
+        self.suppressions = suppressions or suppression_list
+        self.numbers = numbers or number_pool
+        self.concurrency = concurrency or cfg.get("concurrency", 4)
+        self.max_jobs = max_jobs or cfg.get("max_jobs", 2)
+        self.max_spread_jobs = cfg.get("max_spread_jobs", 4)
+        self.progress_every = progress_every or cfg.get("progress_every", 25)
+        self.heartbeat = cfg.get("heartbeat", 60)
+        self.orphan_after = cfg.get("orphan_after", 300)
+        self.bulk_min = cfg.get("bulk_min", 50)
+        self.bulk_chunk = cfg.get("bulk_chunk", 1000)
+        self.messaging_services = settings["twilio"].get("messaging_services", {})
+        self.notify_services = settings["twilio"].get("notify_services", {})
+        self._active = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._runner = None
+        self._spreader = None
+        self._senders = None
+        self._watch_pid = None
+
+    def _pools(self):
+        # Thread pools don't survive a fork, so each worker process builds its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._runner = ThreadPoolExecutor(max_workers=self.max_jobs,
+                                                      thread_name_prefix="send-job")
+                    self._spreader = ThreadPoolExecutor(max_workers=self.max_spread_jobs,
+                                                        thread_name_prefix="send-spread")
+                    self._senders = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                       thread_name_prefix="send-msg")
+                    self._active = {}
+                    self._pid = os.getpid()
+        return self._runner, self._spreader, self._senders
+
+    def start(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self._watch_pid != os.getpid():
+            with self._lock:
+                if self._watch_pid != os.getpid():
+                    self._watch_pid = os.getpid()
+                    threading.Thread(target=self._watch, name="send-heartbeat", daemon=True).start()
+
+    def _watch(self):
+        while True:
+            try:
+                self.check_jobs()
+            except Exception:
+                logger.exception("Send job heartbeat failed")
+            time.sleep(self.heartbeat)
+
+    def check_jobs(self):
+        """Mark this worker's jobs alive and fail the ones stopped workers left behind"""
+        with self._lock:
+            job_ids = list(self._active) if self._pid == os.getpid() else []
+        if job_ids:
+            self.jobs.touch(job_ids)
+        for job_id, total, sent, failed in self.jobs.fail_orphans(self.orphan_after):
+            logger.warning(f"Send job {job_id} was abandoned by a worker that stopped; "
+                           f"{total - sent - failed} of {total} recipients were not sent to")
+
+    def submit(self, user_id, group_id, from_phone, message, recipients, corps_id=None, spread=0):
+        """Queue a message for every recipient and return the new SendJob
+
+        recipients are (name, phone, recipient_id[, group_id]) rows; group_id is used for
+        rows that don't carry their own.  message is text or a MessageTemplate, and spread is
+        the number of seconds to take over sending it.
+        """
+        runner, spreader, _ = self._pools()
+        suppressed = 0
+        if corps_id is not None:
+            recipients, suppressed = self.suppressions.filter(corps_id, recipients)
+        if not isinstance(message, MessageTemplate):
+            message = MessageTemplate(message)
+        job_id = self.jobs.create(user_id, group_id, message.text, len(recipients), suppressed)
+        job = SendJob(job_id, user_id, group_id, from_phone, message, recipients, corps_id, suppressed, spread)
+        if corps_id is not None and corps_id not in self.messaging_services:
+            job.senders = self.numbers.senders_for(corps_id, [recipient[2] for recipient in recipients if recipient[2]])
+        with self._lock:
+            self._active[job.id] = job
+        (spreader if job.spread and job.total > 1 else runner).submit(self._run, job)
+        return job
+
+    def status(self, job_id):
+        """Return the progress of a job as a dict, or None if it doesn't exist"""
+        job = self._active.get(job_id)
+        if job:
+            return job.to_dict()
+        return self.jobs.get(job_id)
+
+    def wait(self, job_id, timeout=None):
+        """Block until a job started in this process finishes (mostly useful with a fake client)"""
+        job = self._active.get(job_id)
+        if job:
+            job.done_event.wait(timeout)
+        return self.status(job_id)
+
+    def _run(self, job):
+        _, _, senders = self._pools()
+        job.status = "sending"
+        self._save(job)
+        log = MessageLog(self.messages.add_messages)
+        try:
+            notify_sid = self.notify_services.get(job.corps_id)
+            if notify_sid and job.total >= self.bulk_min and not job.spread and not job.template.fields:
+                self._send_bulk(job, notify_sid, log)
+            elif job.spread and job.total > 1:
+                self._send_spread(job, senders, log)
+            else:
+                self._settle([senders.submit(self._send_one, job, recipient, log) for recipient in job.recipients])
+            log.flush()
+            job.status = "done"
+            logger.info(f"Send job {job.id} finished: {job.sent} sent, {job.failed} failed "
+                        f"(group id {job.group_id})")
+        except Exception:
+            job.status = "failed"
+            logger.exception(f"Send job {job.id} failed")
+        finally:
+            log.close()
+            self._save(job)
+            job.done_event.set()
+            with self._lock:
+                self._active.pop(job.id, None)
+
+    def _sending_numbers(self, job, recipient_id):
+        service_sid = self.messaging_services.get(job.corps_id)
+        if service_sid:
+            return [service_sid]
+        return [job.senders.get(recipient_id, job.from_phone)]
+
+    def _send_one(self, job, recipient, log):
+        name, phone, recipient_id = recipient[0], recipient[1], recipient[2]
+        group_id = recipient[3] if len(recipient) > 3 else job.group_id
+        body = job.template.render(name)
+        try:
+            twilio_msg = self.scheduler.send(self._sending_numbers(job, recipient_id), to=phone, body=body)
+        except TwilioRestException as e:
+            logger.warning(f"Send job {job.id}: failed to send to {name} ({phone}): {e.msg}")
+            if e.code == UNSUBSCRIBED and job.corps_id is not None:
+                self.suppressions.add(job.corps_id, phone, str(e.code))
+            done = job.record_failure()
+        except Exception:
+            # A dropped connection or timeout fails this recipient, not the rest of the job
+            logger.exception(f"Send job {job.id}: failed to send to {name} ({phone})")
+            done = job.record_failure()
+        else:
+            log.add_message(twilio_msg.sid, job.user_id, recipient_id, group_id, body)
+            done = job.record_sent(name)
+        self._progress(job, done)
+
+    def _send_spread(self, job, senders, log):
+        """Start one message every spread / total seconds"""
+        gap = job.spread / job.total
+        start = self.scheduler.clock()
+        futures = []
+        try:
+            for i, recipient in enumerate(job.recipients):
+                delay = start + i * gap - self.scheduler.clock()
+                if delay > 0:
+                    self.scheduler.sleep(delay)
+                futures.append(senders.submit(self._send_one, job, recipient, log))
+        finally:
+            wait(futures)
+        self._settle(futures)
+
+    @staticmethod
+    def _settle(futures):
+        """Wait until every send has finished, then raise the first unexpected error, if any
+
+        The job is only marked done or failed (and its log closed) once nothing is still sending.
+        """
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def _send_bulk(self, job, service_sid, log):
+        """Send through Twilio Notify, one API call per bulk_chunk recipients"""
+        notifications = self.client.notify.v1.services(service_sid).notifications
+        for start in range(0, job.total, self.bulk_chunk):
+            chunk = job.recipients[start:start + self.bulk_chunk]
+            bindings = [json.dumps({"binding_type": "sms", "address": recipient[1]}) for recipient in chunk]
+            try:
+                notification = notifications.create(to_binding=bindings, body=job.message)
+            except TwilioRestException as e:
+                logger.warning(f"Send job {job.id}: failed to send to {len(chunk)} recipients: {e.msg}")
+                for _ in chunk:
+                    done = job.record_failure()
+            else:
+                logger.info(f"Send job {job.id}: notification {notification.sid} sent to {len(chunk)} recipients")
+                for recipient in chunk:
+                    group_id = recipient[3] if len(recipient) > 3 else job.group_id
+                    # Notify doesn't report the message sid per recipient, and the notification's
+                    # would never match a status callback, so these rows are logged without one
+                    log.add_message(None, job.user_id, recipient[2], group_id, job.message)
+                    done = job.record_sent(recipient[0])
+            self._progress(job, done, force=True)
+
+    def _progress(self, job, done, force=False):
+        if done < job.total and (force or done % self.progress_every == 0):
+            self._save(job)
+
+    def _save(self, job):
+        try:
+            self.jobs.update(job.id, job.status, job.sent, job.failed)
+        except Exception:
+            logger.exception(f"Could not save progress for send job {job.id}")
+
+
+send_queue = SendQueue()
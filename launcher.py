@@ -1,19 +1,47 @@
-import requests
+import os
+import hmac
 import json
-from loguru import logger
-from db import User, Recipients, Messages
-from utils import welcome_recipient, welcome_user, discord_log
-from flask import Flask, redirect, url_for, request, render_template, flash, session
-from oauthlib.oauth2 import WebApplicationClient
-from flask_login import LoginManager, current_user, login_required, login_user, logout_user
-from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, SelectField, SelectMultipleField, validators
-from twilio.twiml.messaging_response import MessagingResponse
-from twilio.base.exceptions import TwilioRestException
-from config import settings, twilio
-
+from datetime import datetime
+from startup import startup
+with startup.step("import: config"):
+    from config import settings, twilio, http
+    from metrics import metrics
+    from querylog import query_log
+with startup.step("import: flask"):
+    from loguru import logger
+    from flask import Flask, redirect, url_for, request, render_template, flash, session, jsonify, abort, Response
+    from oauthlib.oauth2 import WebApplicationClient
+    from flask_login import LoginManager, current_user, login_required, login_user, logout_user
+    from flask_wtf import FlaskForm
+    from flask_wtf.file import FileField, FileRequired
+    from wtforms import StringField, TextAreaField, SelectField, SelectMultipleField, BooleanField, validators
+    from twilio.twiml.messaging_response import MessagingResponse
+    from twilio.base.exceptions import TwilioRestException
+with startup.step("import: db"):
+    from db import User, Recipients, Messages, Inbound, ScheduledMessages, user_cache, group_index, reference_data, \
+        pool_stats
+with startup.step("import: services"):
+    from utils import welcome_recipient, welcome_user, discord_log, status_callback
+    from jobs import send_queue
+    from discovery import DiscoveryCache
+    from inbound import inbound_processor, status_buffer, valid_signature
+    from suppression import suppressions
+    from phones import phone_lookup
+    from importer import import_recipients
+    from numberpool import number_pool, provisioner
+    from schedules import message_scheduler, REPEATS
+    from templating import MessageTemplate
+    from segments import unicode_chars
+
+# Nothing here touches the database, Twilio or the network at import, so the module can be
+# preloaded by gunicorn; per-process setup happens in create_app and start_worker
 app = Flask(__name__)
 app.secret_key = settings["flask"]["key"]
+# The address Twilio and Google are given for this app, whatever Host the proxy passes on
+public_url = settings["flask"].get("public_url", "https://satext.com").rstrip("/")
+# Largest request body (a CSV import, in practice) Flask will accept
+max_upload_mb = settings["flask"].get("max_upload_mb", 2)
+app.config["MAX_CONTENT_LENGTH"] = max_upload_mb * 1024 * 1024
 
 
 # Flask-Login
@@ -21,27 +49,71 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "/login"
 
+# Request latency histograms for /metrics, if enabled, and per-request query counts
+metrics.init_app(app)
+query_log.init_app(app)
+
 # Google Configuration
 google_client_id = settings["google"]["id"]
 google_client_secret = settings["google"]["secret"]
 google_discovery_url = "https://accounts.google.com/.well-known/openid-configuration"
+google_discovery = DiscoveryCache(google_discovery_url,
+                                  settings["google"].get("discovery_cache", "google-discovery.json"),
+                                  session=http)
 
 # OAuth2 client setup
 client = WebApplicationClient(google_client_id)
 
-# Send logs to discord
-logger.add(discord_log, level="INFO")
-
 # TODO can you add a bookmark link?
 
+_logging_configured = False
+_worker_pid = None
+
+
+def configure_logging():
+    """Send logs to discord; loguru handlers are per process, so this only runs once"""
+    global _logging_configured
+    if not _logging_configured:
+        _logging_configured = True
+        logger.add(discord_log, level="INFO")
+
+
+def create_app():
+    """App factory for gunicorn: gunicorn -c gunicorn.conf.py "launcher:create_app()" """
+    with startup.step("create app"):
+        configure_logging()
+    return app
+
+
+@app.before_request
+def start_worker():
+    """Start this process's background threads; gunicorn.conf.py calls it right after fork"""
+    global _worker_pid
+    if _worker_pid != os.getpid():
+        _worker_pid = os.getpid()
+        with startup.step("start worker"):
+            configure_logging()
+            provisioner.start()
+            send_queue.start()
+            message_scheduler.start()
+            inbound_processor.wake()
+        logger.info(f"Worker {_worker_pid} started: {startup.summary()}")
+
+
+def public_request_url():
+    """The URL Twilio signed for this request: public_url plus the path and query string"""
+    query = request.query_string.decode()
+    return f"{public_url}{request.script_root}{request.path}" + (f"?{query}" if query else "")
+
 
 # Get Google Provider
 def get_google_provider_cfg():
-    return requests.get(google_discovery_url).json()
+    return google_discovery.get()
 
 
 class MessageForm(FlaskForm):
-    group = SelectField("Recipients:", coerce=int)
+    groups = SelectMultipleField("Recipients:", coerce=int)
+    everyone = BooleanField("Everyone in the corps")
     msg = TextAreaField("Message:", validators=[validators.DataRequired()])
 
 
@@ -50,8 +122,7 @@ class MenuForm(FlaskForm):
 
 
 class DivisionForm(FlaskForm):
-    divisions = User.get_divisions()
-    division = SelectField("Division:", choices=divisions, coerce=int)
+    division = SelectField("Division:", coerce=int)
 
 
 class CorpsForm(FlaskForm):
@@ -78,6 +149,12 @@ class AddGroupForm(FlaskForm):
 class GroupForm(FlaskForm):
     groups = SelectMultipleField("Groups:", coerce=int)
 
+
+class ImportForm(FlaskForm):
+    file = FileField("CSV file:", validators=[FileRequired()])
+    groups = SelectMultipleField("Add everyone to:", coerce=int)
+    welcome = BooleanField("Send the welcome text to new recipients", default=True)
+
 # Flask-login helper to retrieve a user from our db
 @login_manager.user_loader
 def load_user(user_id):
@@ -86,11 +163,29 @@ def load_user(user_id):
 
 @app.route("/sms", methods=["GET", "POST"])
 def incoming_sms():
-    """Respond to incoming sms"""
-    resp = MessagingResponse()
-    resp.message = "At this time, SA Text does not support SMS responses. But in the future, we hope to do so!"
-    logger.info("Message received")
-    return str(resp)
+    """Store an incoming sms for the inbound processor and acknowledge it straight away"""
+    url = public_request_url()
+    if not valid_signature(url, request.values.to_dict(), request.headers.get("X-Twilio-Signature", "")):
+        abort(403)
+    if Inbound.add(request.values.get("MessageSid"),
+                   request.values.get("From", ""),
+                   request.values.get("To"),
+                   request.values.get("Body"),
+                   request.values.to_dict()):
+        inbound_processor.wake()
+    return str(MessagingResponse()), 200, {"Content-Type": "text/xml"}
+
+
+@app.route("/sms/status", methods=["POST"])
+def message_status():
+    """Twilio delivery status callback; buffered and written to messages in batches"""
+    url = public_request_url()
+    if not valid_signature(url, request.form.to_dict(), request.headers.get("X-Twilio-Signature", "")):
+        abort(403)
+    status_buffer.add(request.form.get("MessageSid"),
+                      request.form.get("MessageStatus"),
+                      request.form.get("ErrorCode"))
+    return "", 204
 
 
 @app.route("/")
@@ -109,7 +204,7 @@ def login():
     # Use library to construct the request for Google login and provide
     # scopes that let you retrieve user's profile from Google
     request_uri = client.prepare_request_uri(authorization_endpoint,
-                                             redirect_uri="https://satext.com/login/callback",
+                                             redirect_uri=f"{public_url}/login/callback",
                                              scope=["openid", "email", "profile"])
     return redirect(request_uri)
 
@@ -129,10 +224,10 @@ def callback():
                                                             authorization_response=url,
                                                             redirect_url=base_url,
                                                             code=code)
-    token_response = requests.post(token_url,
-                                   headers=headers,
-                                   data=body,
-                                   auth=(google_client_id, google_client_secret))
+    token_response = http.post(token_url,
+                               headers=headers,
+                               data=body,
+                               auth=(google_client_id, google_client_secret))
 
     # Parse the tokens!
     client.parse_request_body_response(json.dumps(token_response.json()))
@@ -141,7 +236,7 @@ def callback():
     # including their Google profile image and email
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
     uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    userinfo_response = http.get(uri, headers=headers, data=body)
     # You want to make sure their email is verified.
     # The user authenticated with Google, authorized your
     # app, and now you've verified their email through Google!
@@ -153,10 +248,10 @@ def callback():
     else:
         return "User email not available or not verified by Google.", 400
     # Check if user exists. If not, go to create page (to select corps)
-    if not User.get(unique_id):
+    user = User.get(unique_id)
+    if not user:
         User.create(unique_id, users_name, users_email, picture)
         return redirect(url_for("user_select_corps"))
-    user = User.get(unique_id)
     login_user(user)
     return redirect(url_for("send_msg"))
 
@@ -179,41 +274,165 @@ def protect():
     # return search_twilio_numbers(twilio, "434")
 
 
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus scrape endpoint, for admins or a scraper holding metrics.token"""
+    token = settings.get("metrics", {}).get("token")
+    bearer = request.headers.get("Authorization", "")
+    if not (token and hmac.compare_digest(bearer, f"Bearer {token}")):
+        if not current_user.is_authenticated or not current_user.is_admin:
+            abort(403)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/stats")
+@login_required
+def stats():
+    """Admin only view of this worker's caches and subsystem counters"""
+    if not current_user.is_admin:
+        return redirect(url_for("send_msg"))
+    return jsonify(pid=os.getpid(),
+                   db_pool=pool_stats(),
+                   queries=query_log.stats(),
+                   user_cache=user_cache.stats(),
+                   group_index=group_index.stats(),
+                   reference_data=reference_data.stats(),
+                   discord_log=discord_log.stats(),
+                   http=http.stats(),
+                   send_pacing=send_queue.scheduler.stats(),
+                   inbound=inbound_processor.stats(),
+                   status_callbacks=status_buffer.stats(),
+                   suppressions=suppressions.stats(),
+                   phone_lookups=phone_lookup.stats(),
+                   number_provisioning=provisioner.stats(),
+                   scheduled_messages=message_scheduler.stats(),
+                   startup_ms=startup.report())
+
+
+def resolve_recipients(groups, everyone):
+    """Recipients for the send page's selection, with the group id to log and a description"""
+    if everyone:
+        return Recipients.get_recipients_by_corps(current_user.corps_id), 0, "everyone in the corps"
+    group = int(groups[0]) if len(groups) == 1 else 0
+    return Recipients.get_recipients_by_groups(groups), group, f"group ids {', '.join(groups)}"
+
+
+def send_preview(template, recipients):
+    """What the send page shows before a message goes out: counts, segments, cost and a sample"""
+    allowed, suppressed = suppressions.filter(current_user.corps_id, recipients, count=False)
+    return {"estimate": template.estimate([recipient[0] for recipient in allowed]),
+            "suppressed": suppressed,
+            "sample": template.render(allowed[0][0]) if allowed else template.text,
+            "unicode": unicode_chars(template.text)}
+
+
 @app.route("/send_msg", methods=["GET", "POST"])
 @login_required
 def send_msg():
-    """Main page used for sending messages to groups"""
+    """Main page used for sending messages to groups
+
+    Submitting the form first shows a preview with the segment count and estimated cost;
+    the message is only sent or scheduled once that preview is confirmed unchanged.
+    """
     # TODO set up a way to handle responses
     if current_user.is_approved:
         form = MessageForm(request.form)
-        form.group.choices = Recipients.get_groups_by_user(current_user.corps_id)
+        form.groups.choices = Recipients.get_groups_by_user(current_user.corps_id)
+        preview = None
         if request.method == "POST":
-            group = request.form["group"]
+            groups = request.form.getlist("groups")
+            everyone = "everyone" in request.form
             message = request.form["msg"]
-            if group and message:
-                if "corps_phone" not in session:
-                    session["corps_phone"] = User.get_corps_phone(current_user.corps_id)
-                recipients = Recipients.get_recipients_by_group(group)
-                names = []
-                logger.info(f"{message} sending to group id {group}")
-                for recipient in recipients:
-                    names.append(recipient[0])
-                    twilio_msg = twilio.messages.create(to=recipient[1],
-                                                        from_=session["corps_phone"],
-                                                        body=message)
-                    Messages.add_message(twilio_msg.sid, current_user.id, recipient[2], group, message)
-                flash(f"Message sent to: {', '.join(names)}", "Success")
+            # Only the corps' own active groups can be sent to, whatever the form says
+            if not set(groups) <= {str(group_id) for group_id, _ in form.groups.choices}:
+                flash("Please choose from your corps' groups.", "Error")
+                return redirect(url_for("send_msg"))
+            if (groups or everyone) and message:
+                template = MessageTemplate(message)
+                # The preview only counts for the exact selection and text it was shown for
+                selection = f"{everyone}|{','.join(groups)}|{message}"
+                confirmed = request.form.get("action") == "send" and request.form.get("previewed") == selection
+                if not confirmed:
+                    preview = send_preview(template, resolve_recipients(groups, everyone)[0])
+                    preview["selection"] = selection
+                elif request.form.get("send_at"):
+                    try:
+                        local_time = datetime.strptime(request.form["send_at"], "%Y-%m-%dT%H:%M")
+                    except ValueError:
+                        flash("Please enter a valid date and time.", "Error")
+                        return redirect(url_for("send_msg"))
+                    repeat = request.form.get("repeat", "once")
+                    schedule_id = message_scheduler.schedule(current_user.id, current_user.corps_id,
+                                                             [] if everyone else groups, everyone, message,
+                                                             local_time, repeat if repeat in REPEATS else "once",
+                                                             request.form.get("spread", 0, type=int))
+                    logger.info(f"{current_user.name}({current_user.id}) scheduled {message} "
+                                f"for {local_time} (schedule {schedule_id})")
+                    flash(f"Message scheduled for {local_time:%b %d at %I:%M %p}.", "Success")
+                    return redirect(url_for("scheduled_messages"))
+                else:
+                    if "corps_phone" not in session:
+                        session["corps_phone"] = User.get_corps_phone(current_user.corps_id)
+                    recipients, group, target = resolve_recipients(groups, everyone)
+                    job = send_queue.submit(current_user.id, group, session["corps_phone"], template, recipients,
+                                            corps_id=current_user.corps_id)
+                    logger.info(f"{message} queued for {target} (send job {job.id})")
+                    flash(f"Sending message to {job.total} recipients.", "Success")
+                    return redirect(url_for("send_msg", job=job.id))
             else:
                 flash("All form fields are required.", "Error")
         return render_template("sendmsg.html",
                                form=form,
-                               choices=form.group.choices,
+                               choices=form.groups.choices,
+                               values=request.form,
+                               selected=request.form.getlist("groups"),
+                               preview=preview,
+                               job_id=request.args.get("job", type=int),
                                user_name=current_user.name,
                                profile_pic=current_user.profile_pic)
     else:
         return render_template("approval.html", name=current_user.name)
 
 
+@app.route("/scheduled", methods=["GET", "POST"])
+@login_required
+def scheduled_messages():
+    """Pending scheduled and repeating messages for the user's corps"""
+    if not current_user.is_approved:
+        return render_template("approval.html", name=current_user.name)
+    form = FlaskForm()
+    if request.method == "POST":
+        if ScheduledMessages.cancel(request.form.get("schedule", type=int), current_user.corps_id):
+            logger.info(f"{current_user.name}({current_user.id}) cancelled schedule {request.form['schedule']}")
+            flash("Scheduled message cancelled.", "Success")
+        return redirect(url_for("scheduled_messages"))
+    groups = dict(Recipients.get_groups_by_user(current_user.corps_id))
+    repeats = {every: name for name, every in REPEATS.items()}
+    schedules = [{"id": schedule_id,
+                  "message": message,
+                  "to": "Everyone" if everyone else ", ".join(groups.get(g, "(removed group)") for g in group_ids),
+                  "next_run": message_scheduler.local(next_run),
+                  "repeat": repeats.get(every, "once"),
+                  "spread": spread // 60}
+                 for schedule_id, _, group_ids, everyone, message, next_run, every, spread, _ in
+                 ScheduledMessages.get_by_corps(current_user.corps_id)]
+    return render_template("scheduled.html",
+                           form=form,
+                           schedules=schedules,
+                           user_name=current_user.name,
+                           profile_pic=current_user.profile_pic)
+
+
+@app.route("/send_status/<int:job_id>")
+@login_required
+def send_status(job_id):
+    """Progress of a background send job, polled by the send page"""
+    job = send_queue.status(job_id)
+    if not job or job["user_id"] != current_user.id:
+        abort(404)
+    return jsonify(job)
+
+
 @app.route("/corps", methods=["GET", "POST"])
 @login_required
 def user_select_corps():
@@ -234,6 +453,7 @@ def user_select_corps():
         else:
             flash("Something has gone wrong. Please try  refreshing the page.", "Error")
     form = DivisionForm()
+    form.division.choices = User.get_divisions()
     return render_template("division.html",
                            form=form,
                            divisions=form.division.choices,
@@ -247,14 +467,16 @@ def user_add_phone():
     form = SingleTextForm(request.form)
     if request.method == "POST":
         try:
-            number_info = twilio.lookups.phone_numbers(form.text_field.data).fetch()
-            new_phone = number_info.phone_number[2:]
-            logger.debug(new_phone)
+            number = phone_lookup.lookup(form.text_field.data)
         except TwilioRestException:
+            number = None
+        if not number:
             flash("Invalid phone number", "Error")
             return render_template("updatephone.html",
                                    form=form,
                                    profile_pic=current_user.profile_pic)
+        new_phone = number[2:]
+        logger.debug(new_phone)
         User.update_phone(current_user.id, new_phone)
         if not current_user.is_approved:
             return redirect(url_for("approval"))
@@ -283,6 +505,7 @@ def approve_user():
         if request.method == "GET":
             # Approve this user in the database
             approved_user = User.approve(request.args.get("uid"))
+            provisioner.wake()
             corps_phone = User.get_corps_phone(approved_user.corps_id)
             response = welcome_user(approved_user.id, approved_user.name, f"+1{approved_user.phone}", corps_phone)
             Messages.add_message(*response)
@@ -306,7 +529,8 @@ def approval():
     body = f"{user_name} has requested access for {corps_name}. https://satext.com/approve"
     twilio_msg = twilio.messages.create(to=settings["twilio"]["admin_num"],
                                         from_=settings["twilio"]["phone_num"],
-                                        body=body)
+                                        body=body,
+                                        status_callback=status_callback)
     Messages.add_message(twilio_msg.sid, "SYSTEM", 1, 0, body)
     return render_template("approval.html", name=current_user.name)
 
@@ -325,6 +549,8 @@ def menu():
             return redirect(url_for("add_group"))
         if request.form["actions"] == "4":
             return redirect(url_for("remove_group"))
+        if request.form["actions"] == "5":
+            return redirect(url_for("import_recipient_file"))
         flash("Please select an item from the list.", "Error")
     else:
         return render_template("menu.html",
@@ -340,21 +566,25 @@ def add_recipient():
     if request.method == "POST":
         if request.form["phone"] and request.form["name"]:
             try:
-                number_info = twilio.lookups.phone_numbers(request.form["phone"]).fetch()
-                session["new_phone"] = number_info.phone_number[2:]
+                number = phone_lookup.lookup(request.form["phone"])
             except TwilioRestException:
+                number = None
+            if not number:
                 flash("Invalid phone number", "Error")
                 return render_template("addrecipient.html",
                                        form=form,
                                        profile_pic=current_user.profile_pic)
+            session["new_phone"] = number[2:]
             session["new_name"] = request.form["name"]
             session["recipient_id"] = Recipients.create(request.form["name"],
                                                         session["new_phone"],
                                                         current_user.corps_id)
             if "corps_phone" not in session:
                 session["corps_phone"] = User.get_corps_phone(current_user.corps_id)
-            response = welcome_recipient(session["recipient_id"], request.form["name"],
-                                         number_info.phone_number, session["corps_phone"])
+            # Welcome them from the pool number they'll keep getting messages from
+            senders = number_pool.senders_for(current_user.corps_id, [session["recipient_id"]])
+            response = welcome_recipient(session["recipient_id"], request.form["name"], number,
+                                         senders.get(session["recipient_id"], session["corps_phone"]))
             Messages.add_message(*response)
             logger.info(f"New recipient ({session['recipient_id']}) added to the database by "
                         f"{current_user.name}({current_user.id})")
@@ -367,6 +597,37 @@ def add_recipient():
                                profile_pic=current_user.profile_pic)
 
 
+@app.route("/importrecipients", methods=["GET", "POST"])
+@login_required
+def import_recipient_file():
+    """This page allows a user to add many recipients for their corps from a CSV file"""
+    if not current_user.is_approved:
+        return render_template("approval.html", name=current_user.name)
+    form = ImportForm()
+    form.groups.choices = Recipients.get_groups_by_user(current_user.corps_id)
+    report = None
+    if request.method == "POST":
+        if "file" in request.files and request.files["file"].filename:
+            report = import_recipients(request.files["file"].stream,
+                                       current_user.corps_id,
+                                       [int(group_id) for group_id in request.form.getlist("groups")],
+                                       welcome="welcome" in request.form)
+            logger.info(f"{current_user.name}({current_user.id}) imported {report.added} recipients")
+        else:
+            flash("Please choose a CSV file to import.", "Error")
+    return render_template("importrecipients.html",
+                           form=form,
+                           groups=form.groups.choices,
+                           report=report,
+                           profile_pic=current_user.profile_pic)
+
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    flash(f"That file is too large. Files can be up to {max_upload_mb} MB.", "Error")
+    return redirect(url_for("import_recipient_file"))
+
+
 @app.route("/removerecipient", methods=["GET", "POST"])
 @login_required
 def remove_recipient():
@@ -445,12 +706,10 @@ def manage_recipient():
     if request.method == "POST":
         if request.form["name"] != session["new_name"] or request.form["phone"] != session["new_phone"]:
             Recipients.update(session["recipient_id"], request.form["name"], request.form["phone"])
-        Recipients.clear_groups(session["recipient_id"])
-        for group_id in form.groups.data:
-            try:
-                Recipients.assign_groups(session["recipient_id"], group_id)
-            except:
-                logger.exception("Failure on assign_groups")
+        try:
+            Recipients.set_groups(session["recipient_id"], form.groups.data)
+        except Exception:
+            logger.exception("Failure on set_groups")
         logger.info(f"Added recipient {session['recipient_id']} to groups {form.groups.data}")
         flash(f"{session['new_name']} is now attached to the selected groups.", "Success")
         session.pop("recipient_id", None)
@@ -486,7 +745,8 @@ def contact_us():
     if request.method == "POST":
         twilio_msg = twilio.messages.create(to=settings["twilio"]["admin_num"],
                                             from_=settings["twilio"]["phone_num"],
-                                            body="New contact us form completed.")
+                                            body="New contact us form completed.",
+                                            status_callback=status_callback)
         Messages.add_message(twilio_msg.sid, current_user.id, 0, 0, form.msg.data)
         flash("Your message has been received. We'll get back to you soon!")
         logger.info(f"Contact form submitted by {current_user.name} ({current_user.id})")
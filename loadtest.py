@@ -0,0 +1,460 @@
+"""Load tests for the web app, run against local stand-ins
+
+Serves launcher.app on a local port with every outbound call (Twilio, Google sign-in, the
+Discord webhook) answered by fakes.FakeServices, and with the database pointed at a
+throwaway schema built from BASE_SCHEMA and migrations/.  The schema is dropped when the
+run ends.  The Postgres user in config.yaml needs permission to create schemas.
+
+    python loadtest.py                              # every scenario
+    python loadtest.py send --recipients 1000
+    python loadtest.py --save loadtest-baseline.json
+    python loadtest.py --compare loadtest-baseline.json
+
+Each scenario reports requests per second and, per endpoint, p50/p99 latency and queries
+per request (from the Server-Timing header set by querylog.QueryLog).  --compare exits
+with status 1 if a latency got more than --tolerance worse, a rate dropped by as much, or
+any query count went up.
+"""
+import argparse
+import glob
+import html
+import json
+import logging
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+import psycopg2
+import requests
+from loguru import logger
+from twilio.request_validator import RequestValidator
+from config import settings, http
+from fakes import FakeServices
+from querylog import query_log
+
+# The tables that predate migrations/, as db.py uses them
+BASE_SCHEMA = """
+CREATE TABLE divisions (
+    id   serial PRIMARY KEY,
+    name text NOT NULL
+);
+
+CREATE TABLE corps (
+    id     serial PRIMARY KEY,
+    name   text NOT NULL,
+    div_id integer NOT NULL REFERENCES divisions,
+    phone  text
+);
+
+CREATE TABLE users (
+    id          text PRIMARY KEY,
+    name        text NOT NULL,
+    email       text NOT NULL,
+    phone       text,
+    profile_pic text,
+    corps_id    integer REFERENCES corps,
+    is_admin    integer NOT NULL DEFAULT 0,
+    is_approved integer NOT NULL DEFAULT 0
+);
+
+CREATE TABLE recipients (
+    id       serial PRIMARY KEY,
+    name     text NOT NULL,
+    phone    text NOT NULL,
+    corps_id integer NOT NULL REFERENCES corps
+);
+
+CREATE TABLE groups (
+    id       serial PRIMARY KEY,
+    name     text NOT NULL,
+    corps_id integer NOT NULL REFERENCES corps,
+    active   integer NOT NULL DEFAULT 1
+);
+
+CREATE TABLE recipient_groups (
+    recipient_id integer NOT NULL REFERENCES recipients ON DELETE CASCADE,
+    group_id     integer NOT NULL REFERENCES groups,
+    PRIMARY KEY (recipient_id, group_id)
+);
+
+CREATE TABLE messages (
+    id           serial PRIMARY KEY,
+    sid          text,
+    user_id      text,
+    recipient_id integer,
+    group_id     integer,
+    message      text,
+    sent_at      timestamp NOT NULL DEFAULT now()
+);
+"""
+
+USER_ID = "loadtest"
+server_timing_re = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+previewed_re = re.compile(r'name="previewed" value="([^"]*)"')
+
+# Higher is better for these; everything else reported in ms or queries is lower-is-better
+RATES = ("requests_per_second", "messages_per_second")
+
+
+def connect():
+    pg = settings["pg"]
+    return psycopg2.connect(host="localhost", dbname=pg["dbname"], user=pg["user"], password=pg["password"])
+
+
+def create_schema(schema):
+    """Create the schema with the base tables and every migration, in order"""
+    conn = connect()
+    with conn, conn.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA {schema}")
+        cursor.execute(f"SET search_path TO {schema}")
+        cursor.execute(BASE_SCHEMA)
+        for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations", "*.sql"))):
+            with open(path) as f:
+                cursor.execute(f.read())
+    conn.close()
+
+
+def drop_schema(schema):
+    conn = connect()
+    with conn, conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    conn.close()
+
+
+def seed(schema, recipients, numbers):
+    """One corps with an approved user, its sending numbers and recipients in one group
+
+    Returns a dict of the ids and numbers the scenarios need.
+    """
+    conn = connect()
+    with conn, conn.cursor() as cursor:
+        cursor.execute(f"SET search_path TO {schema}")
+        cursor.execute("INSERT INTO divisions (name) VALUES ('Load Test Division') RETURNING id")
+        div_id = cursor.fetchone()[0]
+        sending = [f"555555{i:04d}" for i in range(numbers)]
+        cursor.execute("INSERT INTO corps (name, div_id, phone) VALUES ('Load Test Corps', %s, %s) RETURNING id",
+                       [div_id, sending[0]])
+        corps_id = cursor.fetchone()[0]
+        cursor.execute("INSERT INTO corps_numbers (phone, corps_id) SELECT unnest(%s::text[]), %s",
+                       [sending, corps_id])
+        cursor.execute("INSERT INTO users (id, name, email, phone, corps_id, is_approved) "
+                       "VALUES (%s, 'Load Test', 'loadtest@example.org', '5555550199', %s, 1)",
+                       [USER_ID, corps_id])
+        cursor.execute("INSERT INTO groups (name, corps_id) VALUES ('Everyone', %s), ('Edited', %s) RETURNING id",
+                       [corps_id, corps_id])
+        group_id, edit_group_id = [row[0] for row in cursor.fetchall()]
+        cursor.execute("INSERT INTO recipients (name, phone, corps_id) "
+                       "SELECT 'Recipient ' || i, '556' || lpad(i::text, 7, '0'), %s "
+                       "FROM generate_series(1, %s) i "
+                       "RETURNING id, phone", [corps_id, recipients])
+        rows = sorted(cursor.fetchall())
+        cursor.execute("INSERT INTO recipient_groups (recipient_id, group_id) SELECT unnest(%s::integer[]), %s",
+                       [[row[0] for row in rows], group_id])
+    conn.close()
+    return {"corps_id": corps_id,
+            "group_id": group_id,
+            "edit_group_id": edit_group_id,
+            "recipients": rows,
+            "numbers": [f"+1{number}" for number in sending]}
+
+
+def configure(args, schema):
+    """Point the app at the schema and the fakes; must run before db/jobs/launcher are imported"""
+    # libpq reads PGOPTIONS for every connection, so the pool needs no changes
+    os.environ["PGOPTIONS"] = f"-c search_path={schema}"
+    send = settings.setdefault("send", {})
+    send["rate"] = args.rate or 1e9
+    send.pop("rates", None)
+    settings["twilio"].pop("messaging_services", None)
+    settings["twilio"].pop("notify_services", None)
+    settings.setdefault("numbers", {})["max_numbers"] = args.numbers
+    settings.setdefault("google", {})["discovery_cache"] = os.path.join(tempfile.mkdtemp(), "discovery.json")
+    # Keep periodic polls and cache checks out of the measured work, so query counts repeat
+    settings.setdefault("inbound", {})["poll_interval"] = 3600
+    settings.setdefault("schedule", {})["poll_interval"] = 3600
+    settings.setdefault("suppression", {})["refresh_interval"] = 3600
+    cache = settings.setdefault("cache", {})
+    cache.setdefault("reference", {})["check_interval"] = 3600
+    cache.setdefault("users", {})["ttl"] = 3600
+    cache.setdefault("groups", {})["ttl"] = 3600
+
+
+class Samples:
+    """Latency and query count of every request made in one scenario, by endpoint"""
+    def __init__(self):
+        self.requests = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def request(self, session, method, url, endpoint, **kwargs):
+        kwargs.setdefault("allow_redirects", False)
+        start = time.perf_counter()
+        response = session.request(method, url, **kwargs)
+        seconds = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {url} returned {response.status_code}")
+        match = server_timing_re.search(response.headers.get("Server-Timing", ""))
+        with self._lock:
+            self.requests.setdefault(endpoint, []).append((seconds, int(match.group(2)) if match else 0))
+        return response
+
+    def summary(self, **extra):
+        elapsed = time.perf_counter() - self.started
+        total = sum(len(samples) for samples in self.requests.values())
+        endpoints = {}
+        for endpoint, samples in self.requests.items():
+            latencies = sorted(seconds for seconds, _ in samples)
+            endpoints[endpoint] = {"requests": len(samples),
+                                   "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                                   "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+                                   "queries": round(sum(queries for _, queries in samples) / len(samples), 2)}
+        return dict({"seconds": round(elapsed, 2),
+                     "requests_per_second": round(total / elapsed, 1),
+                     "endpoints": endpoints}, **extra)
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list"""
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def login(base, samples):
+    """A session signed in through the fake Google provider as the seeded user"""
+    session = requests.Session()
+    samples.request(session, "GET", f"{base}/login", "login")
+    samples.request(session, "GET", f"{base}/login/callback", "login/callback", params={"code": USER_ID})
+    return session
+
+
+def per_thread_sessions(base, samples):
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = login(base, samples)
+        return local.session
+    return session
+
+
+def scenario_send(launcher, base, data, args):
+    """Preview and send a personalized message to the whole group, then wait for the job"""
+    samples = Samples()
+    session = login(base, samples)
+    samples.request(session, "GET", f"{base}/send_msg", "send_msg")
+    sent = messages_seconds = job_queries = 0
+    for i in range(args.sends):
+        message = f"Load test {i}: practice moves to 7pm tonight, {{first_name}}. Reply STOP to opt out."
+        form = {"groups": str(data["group_id"]), "msg": message}
+        response = samples.request(session, "POST", f"{base}/send_msg", "send_msg preview",
+                                   data=dict(form, action="preview"))
+        previewed = html.unescape(previewed_re.search(response.text).group(1))
+        calls = query_log.calls
+        start = time.perf_counter()
+        response = samples.request(session, "POST", f"{base}/send_msg", "send_msg send",
+                                   data=dict(form, action="send", previewed=previewed))
+        job_id = int(parse_qs(urlsplit(response.headers["Location"]).query)["job"][0])
+        job = launcher.send_queue.wait(job_id, timeout=args.timeout)
+        messages_seconds += time.perf_counter() - start
+        job_queries += query_log.calls - calls
+        if job["status"] != "done":
+            raise RuntimeError(f"Send job {job_id} ended as {job['status']}: {job}")
+        sent += job["sent"]
+    return samples.summary(messages_per_second=round(sent / messages_seconds, 1),
+                           queries_per_job=round(job_queries / args.sends, 1))
+
+
+def scenario_webhooks(launcher, base, data, args):
+    """A burst of signed /sms replies, then the wait until the inbound processor has handled them"""
+    import db  # imported late, see main()
+    samples = Samples()
+    validator = RequestValidator(settings["twilio"]["token"])
+    # The view checks the signature against its public address, not the local one
+    url = f"{base}/sms"
+    signed_url = f"{launcher.public_url}/sms"
+    payloads = []
+    for i in range(args.webhooks):
+        # Every tenth message comes from a number that isn't a recipient
+        sender = f"+1557{i:07d}" if i % 10 == 9 else f"+1{data['recipients'][i % len(data['recipients'])][1]}"
+        params = {"MessageSid": f"SMloadtest{i:08d}", "AccountSid": settings["twilio"]["sid"],
+                  "From": sender, "To": data["numbers"][i % len(data["numbers"])],
+                  "Body": "Running a few minutes late, see you there", "NumMedia": "0"}
+        payloads.append((params, validator.compute_signature(signed_url, params)))
+    local = threading.local()
+
+    def post(payload):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        params, signature = payload
+        samples.request(local.session, "POST", url, "sms", data=params, headers={"X-Twilio-Signature": signature})
+
+    with ThreadPoolExecutor(args.clients) as pool:
+        list(pool.map(post, payloads))
+    burst = time.perf_counter() - samples.started
+    deadline = time.monotonic() + args.timeout
+    while True:
+        with db.get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM inbound_messages WHERE status IS NULL OR status = 'claimed'")
+                waiting = cursor.fetchone()[0]
+        conn.close()
+        if not waiting:
+            break
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{waiting} inbound messages still unprocessed after {args.timeout} seconds")
+        time.sleep(0.05)
+    return samples.summary(burst_seconds=round(burst, 2),
+                           drain_seconds=round(time.perf_counter() - samples.started, 2))
+
+
+def scenario_recipients(launcher, base, data, args):
+    """Select and edit recipients, renaming them and toggling a second group"""
+    samples = Samples()
+    session = per_thread_sessions(base, samples)
+
+    def edit(i):
+        recipient_id, phone = data["recipients"][i % len(data["recipients"])]
+        groups = [data["group_id"], data["edit_group_id"]] if i % 2 == 0 else [data["group_id"]]
+        samples.request(session(), "POST", f"{base}/selectrecipient", "selectrecipient",
+                        data={"recipient": recipient_id})
+        samples.request(session(), "POST", f"{base}/managerecipient", "managerecipient",
+                        data={"name": f"Recipient {recipient_id} ({i})", "phone": phone, "groups": groups})
+
+    with ThreadPoolExecutor(args.clients) as pool:
+        list(pool.map(edit, range(args.edits)))
+    return samples.summary()
+
+
+SCENARIOS = {"send": scenario_send, "webhooks": scenario_webhooks, "recipients": scenario_recipients}
+
+
+def report(results):
+    for name, result in results.items():
+        extra = ", ".join(f"{key} {value}" for key, value in result.items() if key != "endpoints")
+        print(f"{name}: {extra}")
+        print(f"  {'endpoint':24} {'requests':>8} {'p50 ms':>9} {'p99 ms':>9} {'queries':>8}")
+        for endpoint, stats in result["endpoints"].items():
+            print(f"  {endpoint:24} {stats['requests']:8} {stats['p50_ms']:9.2f} {stats['p99_ms']:9.2f} "
+                  f"{stats['queries']:8.2f}")
+
+
+def compare(results, baseline, tolerance):
+    """Print how results moved against the baseline; returns the regressions"""
+    regressions = []
+
+    def check(label, key, old, new):
+        if key in RATES:
+            worse = new < old * (1 - tolerance)
+        elif key.endswith("_ms") or key.endswith("seconds"):
+            # Sub-millisecond moves are noise however large they are relatively
+            worse = new > old * (1 + tolerance) and new - old > (1 if key.endswith("_ms") else 0.001)
+        else:
+            worse = new > old
+        change = f"{(new - old) / old * 100:+.0f}%" if old else "new"
+        line = f"  {label} {key}: {old} -> {new} ({change})"
+        print(line + ("  REGRESSION" if worse else ""))
+        if worse:
+            regressions.append(line.strip())
+
+    for name, result in results.items():
+        old_result = baseline["results"].get(name)
+        if old_result is None:
+            continue
+        print(f"{name} against the baseline:")
+        for key, value in result.items():
+            if key != "endpoints" and key in old_result:
+                check(name, key, old_result[key], value)
+        for endpoint, stats in result["endpoints"].items():
+            for key in ("p50_ms", "p99_ms", "queries"):
+                old_stats = old_result["endpoints"].get(endpoint)
+                if old_stats is not None:
+                    check(f"{name} {endpoint}", key, old_stats[key], stats[key])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--recipients", type=int, default=1000, help="recipients in the seeded group")
+    parser.add_argument("--sends", type=int, default=5, help="group sends in the send scenario")
+    parser.add_argument("--webhooks", type=int, default=500, help="/sms requests in the webhook burst")
+    parser.add_argument("--edits", type=int, default=200, help="recipient edits")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients for webhooks and edits")
+    parser.add_argument("--numbers", type=int, default=5, help="sending numbers for the corps")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="messages per second per number (default: no pacing)")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds each fake service call takes")
+    parser.add_argument("--rate-limit-every", type=int, default=0,
+                        help="answer every Nth Twilio message create with a 429")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for background work")
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction a latency or rate may worsen before it's a regression")
+    parser.add_argument("--keep", action="store_true", help="leave the schema in place afterwards")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    scenarios = args.scenarios or list(SCENARIOS)
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    schema = f"loadtest_{os.getpid()}"
+    create_schema(schema)
+    services = FakeServices(latency=args.latency, rate_limit_every=args.rate_limit_every).start()
+    server = None
+    results = {}
+    try:
+        data = seed(schema, max(args.recipients, 1), args.numbers)
+        configure(args, schema)
+        # db, jobs and the rest read their settings at import, so only now can the app load
+        import launcher
+        from werkzeug.serving import make_server
+        # Discord logging would only measure the fake webhook
+        launcher._logging_configured = True
+        services.route(http.session)
+        server = make_server("127.0.0.1", 0, launcher.app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="loadtest-app", daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_address[1]}"
+        for name in scenarios:
+            results[name] = SCENARIOS[name](launcher, base, data, args)
+    finally:
+        if server is not None:
+            server.shutdown()
+        services.stop()
+        if not args.keep:
+            drop_schema(schema)
+
+    report(results)
+    print(f"fake services: {', '.join(f'{key} {value}' for key, value in sorted(services.counts.items()))}")
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("args") != baseline_args(args):
+            print(f"Note: {args.compare} was recorded with {baseline.get('args')}")
+        regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"args": baseline_args(args), "results": results}, f, indent=2)
+        print(f"Results saved to {args.save}")
+    if regressions:
+        print(f"{len(regressions)} regressions")
+        sys.exit(1)
+
+
+def baseline_args(args):
+    """The options that change the numbers, recorded with a baseline"""
+    keys = ("recipients", "sends", "webhooks", "edits", "clients", "numbers", "rate", "latency", "rate_limit_every")
+    return {key: getattr(args, key) for key in keys}
+
+
+if __name__ == "__main__":
+    main()
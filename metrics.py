@@ -0,0 +1,268 @@
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+from loguru import logger
+from config import settings, http
+
+# Latency buckets in seconds, from a cached lookup to a slow Twilio call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+FAMILIES = {"http": ("satext_http_request_seconds", "Flask request latency by endpoint", "endpoint"),
+            "db": ("satext_db_call_seconds", "db.py method latency", "method"),
+            "outbound": ("satext_outbound_seconds", "Outbound HTTP latency by dependency", "dependency")}
+
+# (host, path fragment, name) for the outbound calls worth telling apart; others use the host
+DEPENDENCIES = (("api.twilio.com", "/Messages", "twilio_message_create"),
+                ("api.twilio.com", "/IncomingPhoneNumbers", "twilio_number_buy"),
+                ("api.twilio.com", "/AvailablePhoneNumbers", "twilio_number_search"),
+                ("lookups.twilio.com", "", "twilio_lookup"),
+                ("notify.twilio.com", "", "twilio_notify"),
+                ("oauth2.googleapis.com", "/token", "google_token"),
+                ("openidconnect.googleapis.com", "/userinfo", "google_userinfo"),
+                ("accounts.google.com", "/.well-known/", "google_discovery"),
+                ("discord.com", "/webhooks/", "discord_webhook"),
+                ("discordapp.com", "/webhooks/", "discord_webhook"))
+
+
+def dependency(url):
+    parts = urlsplit(url)
+    for host, fragment, name in DEPENDENCIES:
+        if parts.hostname == host and fragment in parts.path:
+            return name
+    return parts.hostname or "unknown"
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "errors")
+
+    def __init__(self, buckets):
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+
+
+class Metrics:
+    """Latency histograms and error counts, in Prometheus text format
+
+    Each gunicorn worker records into its own memory, and a scrape is answered by whichever
+    worker gets it.  So with ``directory`` set every worker also writes its series to
+    ``worker-<pid>.json`` there, every ``flush_interval`` seconds and as it exits, and
+    render() adds up all the files.  gunicorn.conf.py empties the directory when the app
+    starts and folds each exited worker's file into ``archive.json``, so its counts aren't
+    lost and counters never go backwards.  Without a directory the numbers are this
+    process's alone.
+
+    When ``enabled`` is false nothing is wrapped or hooked in and there is no overhead.
+    """
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS, directory=None, flush_interval=5):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._series = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        # Series and threads aren't carried over a fork, so each worker starts afresh
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._series = {}
+                    if self.directory:
+                        os.makedirs(self.directory, exist_ok=True)
+                        threading.Thread(target=self._run, name="metrics-flush", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not write metrics")
+
+    def observe(self, family, label, seconds, error=False):
+        self._start()
+        with self._lock:
+            histogram = self._series.get((family, label))
+            if histogram is None:
+                histogram = self._series[(family, label)] = Histogram(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram.counts[i] += 1
+                    break
+            histogram.total += seconds
+            histogram.count += 1
+            histogram.errors += error
+
+    def _snapshot(self):
+        with self._lock:
+            return [[family, label, list(h.counts), h.total, h.count, h.errors]
+                    for (family, label), h in self._series.items()]
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def flush(self):
+        """Write this worker's series to its file in ``directory``"""
+        if not (self.enabled and self.directory) or self._pid != os.getpid():
+            return
+        _write(self._path(f"worker-{os.getpid()}.json"), {"series": self._snapshot()})
+
+    def reset(self):
+        """Empty ``directory`` for a fresh start; gunicorn calls this in the master"""
+        if not (self.enabled and self.directory):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for path in glob.glob(self._path("*.json")):
+            os.remove(path)
+
+    def archive(self, pid):
+        """Fold an exited worker's file into archive.json; gunicorn calls this in the master"""
+        if not (self.enabled and self.directory):
+            return
+        path = self._path(f"worker-{pid}.json")
+        worker = _read(path)
+        if worker is None:
+            return
+        archive = _read(self._path("archive.json")) or {"series": [], "workers": []}
+        # render() skips the worker files listed here, so nothing is counted twice before
+        # the file is removed; entries for files already gone are dropped
+        workers = [p for p in archive["workers"] if os.path.exists(self._path(f"worker-{p}.json"))]
+        _write(self._path("archive.json"), {"series": _merge([archive["series"], worker["series"]]),
+                                            "workers": workers + [pid]})
+        os.remove(path)
+
+    def _collect(self):
+        """Every worker's series added up, or just this process's without a directory"""
+        if not self.directory:
+            return self._snapshot()
+        self._start()
+        self.flush()
+        archive = _read(self._path("archive.json")) or {"series": [], "workers": []}
+        archived = {f"worker-{pid}.json" for pid in archive["workers"]}
+        parts = [archive["series"]]
+        for path in glob.glob(self._path("worker-*.json")):
+            if os.path.basename(path) not in archived:
+                worker = _read(path)
+                if worker is not None:
+                    parts.append(worker["series"])
+        return _merge(parts)
+
+    def instrument(self, cls):
+        """Time every static method of a db.py class as "Class.method"
+
+        Already decorated methods (context managers) are left alone, since only the
+        decorator's call would be timed.
+        """
+        if not self.enabled:
+            return cls
+        for name, attr in list(vars(cls).items()):
+            if isinstance(attr, staticmethod) and not hasattr(attr.__func__, "__wrapped__"):
+                setattr(cls, name, staticmethod(self._timed(f"{cls.__name__}.{name}", attr.__func__)))
+        return cls
+
+    def _timed(self, label, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                self.observe("db", label, time.perf_counter() - start, error)
+        return timed
+
+    def init_app(self, app):
+        """Time every Flask request by endpoint"""
+        if not self.enabled:
+            return
+        from flask import g, request
+
+        @app.before_request
+        def start_timer():
+            g.metrics_start = time.perf_counter()
+
+        @app.teardown_request
+        def record_request(error=None):
+            start = g.pop("metrics_start", None)
+            if start is not None:
+                self.observe("http", request.endpoint or "unmatched", time.perf_counter() - start,
+                             error is not None)
+
+    def render(self):
+        """All series in the Prometheus text exposition format"""
+        snapshot = sorted(self._collect())
+        lines = []
+        for key, (name, help_text, label_name) in FAMILIES.items():
+            rows = [row for row in snapshot if row[0] == key]
+            if not rows:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for _, label, counts, total, count, _ in rows:
+                labels = f'{label_name}="{_escape(label)}"'
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f"{name}_sum{{{labels}}} {total:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {count}")
+            errors = name.replace("_seconds", "_errors_total")
+            lines.append(f"# HELP {errors} {help_text.split(' latency')[0]} errors")
+            lines.append(f"# TYPE {errors} counter")
+            for _, label, _, _, _, error_count in rows:
+                lines.append(f'{errors}{{{label_name}="{_escape(label)}"}} {error_count}')
+        return "\n".join(lines) + "\n"
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write(path, data):
+    # Written aside and renamed, so a reader never sees half a file
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp, "w") as f:
+        json.dump(data, f)
+    os.replace(temp, path)
+
+
+def _merge(parts):
+    """Add up lists of [family, label, counts, total, count, errors] series"""
+    merged = {}
+    for series in parts:
+        for family, label, counts, total, count, errors in series:
+            row = merged.get((family, label))
+            if row is None:
+                merged[(family, label)] = [family, label, list(counts), total, count, errors]
+            else:
+                row[2] = [a + b for a, b in zip(row[2], counts)]
+                row[3] += total
+                row[4] += count
+                row[5] += errors
+    return list(merged.values())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_cfg = settings.get("metrics", {})
+metrics = Metrics(enabled=_cfg.get("enabled", False), buckets=_cfg.get("buckets", DEFAULT_BUCKETS),
+                  directory=_cfg.get("dir", "metrics-data"), flush_interval=_cfg.get("flush_interval", 5))
+if metrics.enabled:
+    http.listener = lambda url, seconds, failed: metrics.observe("outbound", dependency(url), seconds, failed)
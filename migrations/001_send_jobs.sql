@@ -0,0 +1,13 @@
+-- Background send jobs for group messages (see jobs.py)
+CREATE TABLE IF NOT EXISTS send_jobs (
+    id          serial PRIMARY KEY,
+    user_id     text NOT NULL,
+    group_id    integer NOT NULL,
+    message     text NOT NULL,
+    status      text NOT NULL DEFAULT 'queued',
+    total       integer NOT NULL DEFAULT 0,
+    sent        integer NOT NULL DEFAULT 0,
+    failed      integer NOT NULL DEFAULT 0,
+    created_at  timestamp NOT NULL DEFAULT now(),
+    finished_at timestamp
+);
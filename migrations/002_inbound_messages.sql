@@ -0,0 +1,20 @@
+-- Raw inbound SMS webhooks, processed in the background (see inbound.py)
+CREATE TABLE IF NOT EXISTS inbound_messages (
+    id           serial PRIMARY KEY,
+    sid          text,
+    from_phone   text NOT NULL,
+    to_phone     text,
+    body         text,
+    payload      jsonb NOT NULL,
+    received_at  timestamp NOT NULL DEFAULT now(),
+    processed_at timestamp,
+    status       text,
+    recipient_id integer,
+    corps_id     integer
+);
+
+CREATE INDEX IF NOT EXISTS inbound_messages_unprocessed_idx
+    ON inbound_messages (id) WHERE processed_at IS NULL;
+
+-- Senders are matched to recipients by number
+CREATE INDEX IF NOT EXISTS recipients_phone_idx ON recipients (phone);
@@ -0,0 +1,7 @@
+-- Delivery status reported by Twilio status callbacks (see inbound.StatusBuffer)
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS status text;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS error_code integer;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS status_updated_at timestamp;
+
+-- Status updates are applied by sid
+CREATE INDEX IF NOT EXISTS messages_sid_idx ON messages (sid);
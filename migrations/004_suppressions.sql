@@ -0,0 +1,13 @@
+-- Numbers that opted out of a corps' messages (see suppression.py)
+CREATE TABLE IF NOT EXISTS suppressions (
+    corps_id   integer NOT NULL,
+    phone      text NOT NULL,
+    reason     text NOT NULL,
+    active     boolean NOT NULL DEFAULT true,
+    updated_at timestamp NOT NULL DEFAULT clock_timestamp(),
+    PRIMARY KEY (corps_id, phone)
+);
+
+CREATE INDEX IF NOT EXISTS suppressions_updated_idx ON suppressions (updated_at);
+
+ALTER TABLE send_jobs ADD COLUMN IF NOT EXISTS suppressed integer NOT NULL DEFAULT 0;
@@ -0,0 +1,7 @@
+-- Results of Twilio phone number lookups, keyed by normalized input (see phones.py)
+CREATE TABLE IF NOT EXISTS phone_lookups (
+    number       text PRIMARY KEY,
+    phone_number text,
+    valid        boolean NOT NULL,
+    looked_up_at timestamp NOT NULL DEFAULT now()
+);
@@ -0,0 +1,20 @@
+-- Sending numbers per corps and the number each recipient is texted from (see numberpool.py)
+CREATE TABLE IF NOT EXISTS corps_numbers (
+    phone      text PRIMARY KEY,
+    corps_id   integer NOT NULL,
+    created_at timestamp NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS corps_numbers_corps_idx ON corps_numbers (corps_id);
+
+-- Each corps' existing number becomes the first in its pool
+INSERT INTO corps_numbers (phone, corps_id)
+SELECT phone, id FROM corps WHERE phone IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS recipient_senders (
+    recipient_id integer PRIMARY KEY,
+    phone        text NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS recipient_senders_phone_idx ON recipient_senders (phone);
@@ -0,0 +1,19 @@
+-- Messages queued for a later time, optionally repeating (see schedules.py)
+CREATE TABLE IF NOT EXISTS scheduled_messages (
+    id         serial PRIMARY KEY,
+    user_id    text NOT NULL,
+    corps_id   integer NOT NULL,
+    group_ids  integer[] NOT NULL DEFAULT '{}',
+    everyone   boolean NOT NULL DEFAULT false,
+    message    text NOT NULL,
+    next_run   timestamptz NOT NULL,
+    every      interval,
+    spread     integer NOT NULL DEFAULT 0,
+    active     boolean NOT NULL DEFAULT true,
+    last_run   timestamptz,
+    last_job   integer,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS scheduled_messages_due_idx ON scheduled_messages (next_run) WHERE active;
+CREATE INDEX IF NOT EXISTS scheduled_messages_corps_idx ON scheduled_messages (corps_id) WHERE active;
@@ -0,0 +1,26 @@
+-- Version number for divisions and corps, bumped on every change so each worker's
+-- reference data cache knows when to reload (see db.ReferenceData)
+CREATE TABLE IF NOT EXISTS reference_version (
+    id      boolean PRIMARY KEY DEFAULT true CHECK (id),
+    version bigint NOT NULL DEFAULT 1
+);
+
+INSERT INTO reference_version (id, version) VALUES (true, 1) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_reference_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE reference_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS divisions_reference_version ON divisions;
+CREATE TRIGGER divisions_reference_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON divisions
+FOR EACH STATEMENT EXECUTE FUNCTION bump_reference_version();
+
+-- Only the columns that are cached; corps.phone changes as numbers are bought
+DROP TRIGGER IF EXISTS corps_reference_version ON corps;
+CREATE TRIGGER corps_reference_version
+AFTER INSERT OR UPDATE OF name, div_id OR DELETE OR TRUNCATE ON corps
+FOR EACH STATEMENT EXECUTE FUNCTION bump_reference_version();
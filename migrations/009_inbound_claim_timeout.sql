@@ -0,0 +1,3 @@
+-- Claimed messages whose worker died before finishing them are claimed again (see inbound.py)
+CREATE INDEX IF NOT EXISTS inbound_messages_claimed_idx
+    ON inbound_messages (processed_at) WHERE status = 'claimed';
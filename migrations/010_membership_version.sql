@@ -0,0 +1,26 @@
+-- Version number for group membership, bumped on every change to recipient_groups or to a
+-- recipient's name or phone, so each worker's group index knows when to reload (see db.GroupIndex)
+CREATE TABLE IF NOT EXISTS membership_version (
+    id      boolean PRIMARY KEY DEFAULT true CHECK (id),
+    version bigint NOT NULL DEFAULT 1
+);
+
+INSERT INTO membership_version (id, version) VALUES (true, 1) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_membership_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE membership_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS recipient_groups_membership_version ON recipient_groups;
+CREATE TRIGGER recipient_groups_membership_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON recipient_groups
+FOR EACH STATEMENT EXECUTE FUNCTION bump_membership_version();
+
+-- A new recipient isn't in any group until a recipient_groups row is added
+DROP TRIGGER IF EXISTS recipients_membership_version ON recipients;
+CREATE TRIGGER recipients_membership_version
+AFTER UPDATE OF name, phone OR DELETE OR TRUNCATE ON recipients
+FOR EACH STATEMENT EXECUTE FUNCTION bump_membership_version();
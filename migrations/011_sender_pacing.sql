@@ -0,0 +1,5 @@
+-- Next send slot for each sending number, shared by every worker (see db.SenderPacing)
+CREATE TABLE IF NOT EXISTS sender_pacing (
+    sender text PRIMARY KEY,
+    tat    timestamptz NOT NULL
+);
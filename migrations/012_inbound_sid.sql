@@ -0,0 +1,8 @@
+-- Twilio retries a webhook it didn't get a timely answer for; the MessageSid makes the
+-- retry a no-op instead of a second forward (see db.Inbound.add).  Earlier duplicates are
+-- dropped first, keeping the copy that arrived first.
+DELETE FROM inbound_messages AS dup
+USING inbound_messages AS first
+WHERE dup.sid = first.sid AND dup.id > first.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS inbound_messages_sid_key ON inbound_messages (sid);
@@ -0,0 +1,6 @@
+-- Workers mark their unfinished send jobs alive every send.heartbeat seconds; a job left
+-- queued or sending by a worker that stopped is failed once it goes quiet (see jobs.py)
+ALTER TABLE send_jobs ADD COLUMN IF NOT EXISTS heartbeat_at timestamp NOT NULL DEFAULT now();
+
+CREATE INDEX IF NOT EXISTS send_jobs_unfinished_idx
+    ON send_jobs (heartbeat_at) WHERE status IN ('queued', 'sending');
@@ -0,0 +1,21 @@
+-- Version number for users, bumped on every change so each worker's user cache drops
+-- approvals, phones and corps that changed elsewhere (see db.UserCache)
+CREATE TABLE IF NOT EXISTS user_version (
+    id      boolean PRIMARY KEY DEFAULT true CHECK (id),
+    version bigint NOT NULL DEFAULT 1
+);
+
+INSERT INTO user_version (id, version) VALUES (true, 1) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_user_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE user_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Users that aren't found aren't cached, so new rows don't need a bump
+DROP TRIGGER IF EXISTS users_user_version ON users;
+CREATE TRIGGER users_user_version
+AFTER UPDATE OR DELETE OR TRUNCATE ON users
+FOR EACH STATEMENT EXECUTE FUNCTION bump_user_version();
@@ -0,0 +1,131 @@
+import os
+import threading
+from loguru import logger
+from twilio.base.exceptions import TwilioRestException
+from config import settings
+from cache import TTLCache
+from db import CorpsNumbers
+from utils import get_new_number
+
+
+class NumberPool:
+    """Chooses which of a corps' numbers each recipient is texted from
+
+    A recipient keeps the same sender once assigned (stored in recipient_senders), so
+    replies and opt-outs stay on one thread.  Recipients without one are spread over the
+    corps' numbers, least loaded first.
+    """
+    def __init__(self, ttl=300):
+        self._numbers = TTLCache(maxsize=1000, ttl=ttl)
+        self._owners = TTLCache(maxsize=5000, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def numbers(self, corps_id):
+        numbers = self._numbers.get(corps_id)
+        if numbers is None:
+            numbers = CorpsNumbers.get(corps_id)
+            self._numbers.set(corps_id, numbers)
+        return numbers
+
+    def corps_for_number(self, phone):
+        """The corps that owns an E.164 sending number, or None"""
+        corps_id = self._owners.get(phone)
+        if corps_id is None:
+            corps_id = CorpsNumbers.get_corps(phone)
+            if corps_id is not None:
+                self._owners.set(phone, corps_id)
+        return corps_id
+
+    def senders_for(self, corps_id, recipient_ids):
+        """{recipient_id: number} for every recipient, assigning new recipients as needed"""
+        numbers = self.numbers(corps_id)
+        if not numbers:
+            return {}
+        senders = CorpsNumbers.get_senders(recipient_ids)
+        unassigned = [recipient_id for recipient_id in recipient_ids
+                      if senders.get(recipient_id) not in numbers]
+        if unassigned:
+            with self._lock:
+                loads = CorpsNumbers.loads(corps_id)
+                assignments = []
+                for recipient_id in unassigned:
+                    number = min(numbers, key=lambda n: loads.get(n, 0))
+                    loads[number] = loads.get(number, 0) + 1
+                    senders[recipient_id] = number
+                    assignments.append((recipient_id, number))
+                CorpsNumbers.set_senders(assignments)
+        return senders
+
+    def added(self, corps_id, phone):
+        self._numbers.pop(corps_id)
+        self._owners.set(phone, corps_id)
+
+
+class Provisioner:
+    """Buys sending numbers for corps in the background, before they're needed
+
+    Each corps with users gets enough numbers for one per ``recipients_per_number``
+    recipients, between ``min_numbers`` and ``max_numbers``.  Every worker runs one, but a
+    Postgres advisory lock lets only one of them buy numbers at a time.
+    """
+    def __init__(self, pool):
+        cfg = settings.get("numbers", {})
+        self.pool = pool
+        self.recipients_per_number = cfg.get("recipients_per_number", 200)
+        self.min_numbers = cfg.get("min_numbers", 1)
+        self.max_numbers = cfg.get("max_numbers", 5)
+        self.interval = cfg.get("interval", 600)
+        self.bought = 0
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._run, name="number-provisioner", daemon=True).start()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.provision()
+            except Exception:
+                logger.exception("Number provisioning failed")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def provision(self):
+        """Buy whatever numbers are missing; returns how many were bought"""
+        bought = 0
+        with CorpsNumbers.provisioning_lock() as locked:
+            if not locked:
+                return 0
+            for corps_id, corps_name, area_code, needed in CorpsNumbers.shortfalls(self.recipients_per_number,
+                                                                                   self.min_numbers,
+                                                                                   self.max_numbers):
+                for _ in range(needed):
+                    try:
+                        phone = get_new_number(area_code or "***", corps_name)
+                    except (TwilioRestException, IndexError):
+                        logger.exception(f"Could not buy a number for {corps_name}")
+                        break
+                    CorpsNumbers.add(corps_id, phone)
+                    self.pool.added(corps_id, phone)
+                    bought += 1
+                    logger.info(f"Bought {phone} for {corps_name}")
+        self.bought += bought
+        return bought
+
+    def stats(self):
+        return {"bought": self.bought}
+
+
+number_pool = NumberPool()
+provisioner = Provisioner(number_pool)
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from twilio.http.http_client import TwilioHttpClient
+
+
+class TimedSession(requests.Session):
+    """requests.Session that applies a default timeout and times every call by host"""
+    def __init__(self, owner):
+        super().__init__()
+        self.owner = owner
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.owner.timeout
+        host = urlsplit(request.url).hostname
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = super().send(request, **kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            seconds = time.perf_counter() - start
+            self.owner.record(host, seconds, failed)
+            if self.owner.listener is not None:
+                self.owner.listener(request.url, seconds, failed)
+
+
+class HttpClient:
+    """One keep-alive session per worker for every outbound call
+
+    Connections are pooled per host, failed connections and idempotent requests are
+    retried with exponential backoff, and the time spent on each host is recorded.
+    ``listener``, if set, is also called with (url, seconds, failed) for every request.
+    """
+    def __init__(self, timeout=10, retries=3, backoff=0.5, pool_size=10):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.listener = None
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        # Pooled sockets must not be shared with a forked child, so each worker gets its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = self._make_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _make_session(self):
+        session = TimedSession(self)
+        retry = Retry(total=self.retries,
+                      backoff_factor=self.backoff,
+                      status_forcelist=(502, 503, 504),
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=self.pool_size, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def record(self, host, seconds, failed):
+        with self._lock:
+            stats = self._hosts.setdefault(host, {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["requests"] += 1
+            stats["errors"] += failed
+            stats["total_ms"] += seconds * 1000
+            stats["max_ms"] = max(stats["max_ms"], seconds * 1000)
+
+    def stats(self):
+        """Request count, error count and latency per host for this worker"""
+        with self._lock:
+            return {host: dict(s, avg_ms=round(s["total_ms"] / s["requests"], 1),
+                               total_ms=round(s["total_ms"], 1),
+                               max_ms=round(s["max_ms"], 1))
+                    for host, s in self._hosts.items()}
+
+
+class TwilioSessionClient(TwilioHttpClient):
+    """Twilio's HTTP client, sending through a shared HttpClient session"""
+    def __init__(self, http):
+        self.http = http
+        super().__init__(timeout=http.timeout)
+
+    @property
+    def session(self):
+        return self.http.session
+
+    @session.setter
+    def session(self, value):
+        # TwilioHttpClient.__init__ assigns its own session; ours is used instead
+        pass
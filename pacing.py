@@ -0,0 +1,153 @@
+import random
+import threading
+import time
+import requests
+from loguru import logger
+from urllib3.exceptions import ConnectTimeoutError
+from twilio.base.exceptions import TwilioRestException
+
+# Twilio's "Too Many Requests" error code; 429 statuses are retried as well
+RETRY_CODES = {20429}
+# Seconds to pace locally after the shared pacing table couldn't be reached
+SHARED_RETRY_AFTER = 30
+
+
+def is_transient(error):
+    """Whether a failed messages.create can be tried again without risking a second text
+
+    That's rate limiting, and connections that failed before the request went out.  A 5xx
+    (or a connection lost mid-request) may come after Twilio queued the message, so like
+    any other error it fails the send, as the HTTP client does for POSTs.
+    """
+    if isinstance(error, TwilioRestException):
+        return error.status == 429 or error.code in RETRY_CODES
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    # Refused and unresolvable connections (urllib3's NewConnectionError) are connect errors too
+    return isinstance(error, requests.ConnectionError) and isinstance(reason, ConnectTimeoutError)
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second with bursts of up to ``burst``"""
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until a token is available"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def reserve(self):
+        """Take a token, going into debt if needed, and return how long to wait before using it"""
+        wait = self.wait_time()
+        self.tokens -= 1
+        return wait
+
+
+class SendScheduler:
+    """Paces messages.create calls to each sending number's allowed rate
+
+    Every sender (a phone number, or a Messaging Service SID starting with ``MG``) has its
+    own token bucket.  When several senders are given the message goes to whichever one
+    frees up first, and rate limits and failed connections (see is_transient) are retried
+    with jittered exponential backoff.  ``clock`` and ``sleep`` can be swapped for a simulated clock.  If
+    ``status_callback`` is set it is passed with every message.
+
+    The buckets only see this process's sends.  ``shared`` (e.g. db.SenderPacing) makes the
+    rate hold across every worker: each message also reserves a slot there with
+    ``shared.reserve(sender, interval, burst)``, which returns the seconds to wait, and the
+    longer of the two waits is used.  If the shared reservation fails, the local buckets
+    alone pace messages for the next ``SHARED_RETRY_AFTER`` seconds; the failure is logged
+    once, not per message, until a reservation succeeds again.
+    """
+    def __init__(self, client, rate=1.0, burst=1, rates=None, retries=4, backoff=1.0,
+                 status_callback=None, clock=time.monotonic, sleep=time.sleep, shared=None):
+        self.client = client
+        self.shared = shared
+        self.status_callback = status_callback
+        self.rate = rate
+        self.burst = burst
+        self.rates = rates or {}
+        self.retries = retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.retried = 0
+        self.waited = 0.0
+        self.shared_failures = 0
+        self._shared_retry_at = None
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, sender):
+        bucket = self._buckets.get(sender)
+        if bucket is None:
+            bucket = TokenBucket(self.rates.get(sender, self.rate), self.burst, self.clock)
+            self._buckets[sender] = bucket
+        return bucket
+
+    def _reserve(self, senders):
+        with self._lock:
+            sender = min(senders, key=lambda s: self._bucket(s).wait_time())
+            bucket = self._bucket(sender)
+            wait = bucket.reserve()
+        if self.shared is not None:
+            wait = max(wait, self._reserve_shared(sender, 1 / bucket.rate))
+        return sender, wait
+
+    def _reserve_shared(self, sender, interval):
+        retry_at = self._shared_retry_at
+        if retry_at is not None and self.clock() < retry_at:
+            return 0.0
+        try:
+            wait = self.shared.reserve(sender, interval, self.burst)
+        except Exception:
+            with self._lock:
+                self.shared_failures += 1
+                first = self._shared_retry_at is None
+                self._shared_retry_at = self.clock() + SHARED_RETRY_AFTER
+            if first:
+                logger.exception("Could not reserve a shared send slot; pacing each worker on its own until "
+                                 "it can be reached")
+            return 0.0
+        if retry_at is not None:
+            self._shared_retry_at = None
+            logger.info("Shared send pacing is back")
+        return wait
+
+    def send(self, senders, to, body, **kwargs):
+        """Create a message from one of senders, waiting for its turn; returns the message"""
+        if self.status_callback:
+            kwargs.setdefault("status_callback", self.status_callback)
+        for attempt in range(self.retries + 1):
+            sender, wait = self._reserve(senders)
+            if wait:
+                self.waited += wait
+                self.sleep(wait)
+            if sender.startswith("MG"):
+                params = dict(kwargs, messaging_service_sid=sender)
+            else:
+                params = dict(kwargs, from_=sender)
+            try:
+                return self.client.messages.create(to=to, body=body, **params)
+            except (TwilioRestException, requests.ConnectionError) as e:
+                if attempt == self.retries or not is_transient(e):
+                    raise
+                self.retried += 1
+                self.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
+
+    def stats(self):
+        return {"senders": len(self._buckets),
+                "retried": self.retried,
+                "waited_seconds": round(self.waited, 1),
+                "shared_failures": self.shared_failures}
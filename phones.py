@@ -0,0 +1,73 @@
+import re
+from loguru import logger
+from twilio.base.exceptions import TwilioRestException
+from config import settings, twilio
+from cache import TTLCache
+from db import PhoneLookups
+
+non_digits_re = re.compile(r"\D")
+# NANP: area code and exchange both start with 2-9, and the area code isn't an N11 code
+nanp_re = re.compile(r"^[2-9](?!11)\d{2}[2-9]\d{6}$")
+
+
+def normalize(raw):
+    """Turn user input into +1XXXXXXXXXX, or None if it can't be a US/Canada number
+
+    Only North American numbers are accepted, since phones are stored as 10 digits.
+    """
+    digits = non_digits_re.sub("", raw or "")
+    if len(digits) == 11 and digits[0] == "1":
+        digits = digits[1:]
+    if not nanp_re.match(digits):
+        return None
+    return f"+1{digits}"
+
+
+class PhoneLookup:
+    """Validates numbers with Twilio Lookup, remembering the answers
+
+    Input that isn't a possible North American number is rejected without any lookup.
+    Otherwise the normalized number is checked in an in-memory LRU, then the phone_lookups
+    table, and only then with Twilio; both valid and invalid answers are kept.
+    """
+    def __init__(self, client=None, size=None, ttl=None, max_age_days=None):
+        cfg = settings.get("cache", {}).get("lookups", {})
+        self.client = client or twilio
+        self.max_age_days = max_age_days or cfg.get("max_age_days", 30)
+        self.rejected = 0
+        self.fetched = 0
+        self._cache = TTLCache(maxsize=size or cfg.get("size", 5000), ttl=ttl or cfg.get("ttl", 3600))
+
+    def lookup(self, raw):
+        """Return the number in E.164 form, or None if it isn't a valid phone number"""
+        number = normalize(raw)
+        if number is None:
+            self.rejected += 1
+            return None
+        cached = self._cache.get(number)
+        if cached is None:
+            cached = PhoneLookups.get(number, self.max_age_days)
+            if cached is None:
+                cached = self._fetch(number)
+                PhoneLookups.save(number, *cached)
+            cached = tuple(cached)
+            self._cache.set(number, cached)
+        valid, phone_number = cached
+        return phone_number if valid else None
+
+    def _fetch(self, number):
+        self.fetched += 1
+        try:
+            number_info = self.client.lookups.phone_numbers(number).fetch()
+        except TwilioRestException as e:
+            if e.status != 404:
+                raise
+            logger.debug(f"Twilio lookup rejected {number}")
+            return False, None
+        return True, number_info.phone_number
+
+    def stats(self):
+        return dict(self._cache.stats(), rejected_locally=self.rejected, twilio_lookups=self.fetched)
+
+
+phone_lookup = PhoneLookup()
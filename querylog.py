@@ -0,0 +1,171 @@
+import functools
+import re
+import threading
+import time
+from collections import deque
+from flask import g, has_request_context, request
+from loguru import logger
+from psycopg2 import extensions
+from config import settings
+
+string_re = re.compile(r"'(?:[^']|'')*'")
+number_re = re.compile(r"(?<![\w$])-?\d+(?:\.\d+)?\b")
+array_re = re.compile(r"ARRAY\[[^\]]*\]")
+rows_re = re.compile(r"\(\?(?:,\s*\?)*\)(?:,\s*\(\?(?:,\s*\?)*\))+")
+space_re = re.compile(r"\s+")
+
+
+def normalize(sql):
+    """SQL with literals replaced by ? and multi-row VALUES lists collapsed, for grouping"""
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", "replace")
+    sql = string_re.sub("?", sql)
+    sql = number_re.sub("?", sql)
+    sql = array_re.sub("ARRAY[?]", sql)
+    sql = rows_re.sub("(?), ...", sql)
+    return space_re.sub(" ", sql).strip()
+
+
+# Parameterized statements repeat exactly, so their normalized text is worth caching;
+# long ones are usually execute_values batches with the values inlined, which never repeat
+_normalize_cached = functools.lru_cache(maxsize=1024)(normalize)
+cache_below = 2000
+
+
+class RequestQueries:
+    """The statements run while handling one Flask request"""
+    __slots__ = ("count", "seconds", "rows", "statements")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.statements = {}
+
+
+class QueryLog:
+    """Records every statement run through a QueryCursor
+
+    Each statement's normalized text, duration and row count is added to per-statement
+    totals for /stats and, inside a Flask request, to that request's totals in ``g``.  A
+    request that runs more than ``budget`` statements, or the same statement more than
+    ``repeat_limit`` times (the N+1 pattern), is logged as a warning when it finishes.
+    Statements slower than ``slow_ms`` are logged, and the latest ``slow_kept`` are kept
+    for /stats.
+    """
+    def __init__(self, budget=40, repeat_limit=10, slow_ms=250, slow_kept=50, max_statements=500):
+        self.budget = budget
+        self.repeat_limit = repeat_limit
+        self.slow_ms = slow_ms
+        self.max_statements = max_statements
+        self.slow = deque(maxlen=slow_kept)
+        self.calls = 0
+        self.over_budget = 0
+        self.repeated = 0
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql, seconds, rows):
+        statement = _normalize_cached(sql) if len(sql) < cache_below else normalize(sql)
+        rows = max(rows, 0)
+        with self._lock:
+            self.calls += 1
+            totals = self._statements.get(statement)
+            if totals is None:
+                if len(self._statements) >= self.max_statements:
+                    statement = "(other)"
+                totals = self._statements.setdefault(statement, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += rows
+        if seconds * 1000 >= self.slow_ms:
+            endpoint = request.endpoint if has_request_context() else None
+            self.slow.append({"ms": round(seconds * 1000, 1), "rows": rows, "endpoint": endpoint,
+                              "statement": statement})
+            logger.warning(f"Slow query ({seconds * 1000:.0f} ms, {rows} rows"
+                           f"{', ' + endpoint if endpoint else ''}): {statement}")
+        if has_request_context():
+            queries = g.get("queries")
+            if queries is not None:
+                queries.count += 1
+                queries.seconds += seconds
+                queries.rows += rows
+                queries.statements[statement] = queries.statements.get(statement, 0) + 1
+
+    def init_app(self, app):
+        @app.before_request
+        def start_queries():
+            g.queries = RequestQueries()
+
+        @app.after_request
+        def report_queries(response):
+            queries = g.get("queries")
+            if queries is not None:
+                response.headers["Server-Timing"] = (f'db;dur={queries.seconds * 1000:.1f};'
+                                                     f'desc="{queries.count} queries"')
+            return response
+
+        @app.teardown_request
+        def check_queries(error=None):
+            queries = g.pop("queries", None)
+            if queries is not None:
+                self.check(request.endpoint, queries)
+
+    def check(self, endpoint, queries):
+        if queries.count > self.budget:
+            self.over_budget += 1
+            logger.warning(f"{endpoint} ran {queries.count} queries ({queries.seconds * 1000:.0f} ms), "
+                           f"over the budget of {self.budget}")
+        for statement, count in queries.statements.items():
+            if count > self.repeat_limit:
+                self.repeated += 1
+                logger.warning(f"{endpoint} ran the same query {count} times: {statement}")
+
+    def stats(self, top=20):
+        """The statements with the most total time, plus recent slow queries"""
+        with self._lock:
+            statements = sorted(self._statements.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        return {"calls": self.calls,
+                "over_budget": self.over_budget,
+                "repeated": self.repeated,
+                "top": [{"statement": statement, "calls": calls, "total_ms": round(seconds * 1000, 1),
+                         "rows": rows}
+                        for statement, (calls, seconds, rows) in statements],
+                "slow": list(self.slow)}
+
+
+class QueryCursor(extensions.cursor):
+    """psycopg2 cursor that reports each statement to query_log"""
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            query_log.record(query, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            query_log.record(query, time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            query_log.record(sql, time.perf_counter() - start, self.rowcount)
+
+
+class QueryConnection(extensions.connection):
+    """psycopg2 connection whose cursors are QueryCursors unless told otherwise"""
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", QueryCursor)
+        return super().cursor(*args, **kwargs)
+
+
+_cfg = settings.get("pg", {})
+query_log = QueryLog(budget=_cfg.get("query_budget", 40),
+                     repeat_limit=_cfg.get("query_repeat_limit", 10),
+                     slow_ms=_cfg.get("slow_query_ms", 250))
@@ -0,0 +1,97 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from loguru import logger
+from config import settings
+from db import ScheduledMessages, Recipients, User
+from jobs import send_queue
+
+# What the send page offers for "Repeat"
+REPEATS = {"once": None, "daily": timedelta(days=1), "weekly": timedelta(weeks=1)}
+
+
+class MessageScheduler:
+    """Sends scheduled and repeating messages when they come due
+
+    Schedules live in the scheduled_messages table.  Every worker polls it each
+    ``poll_interval`` seconds and claims due rows with FOR UPDATE SKIP LOCKED, so however
+    many workers or hosts are running, each run is sent once.  Claimed messages go through
+    the send queue like any other, spread over the schedule's ``spread`` seconds.
+    """
+    def __init__(self, queue=None, batch_size=None, poll_interval=None):
+        cfg = settings.get("schedule", {})
+        self.queue = queue or send_queue
+        self.batch_size = batch_size or cfg.get("batch_size", 10)
+        self.poll_interval = poll_interval or cfg.get("poll_interval", 30)
+        self.max_spread = cfg.get("max_spread", 120) * 60
+        self.timezone = ZoneInfo(cfg.get("timezone", "America/New_York"))
+        self.started = 0
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._run, name="scheduled-sms", daemon=True).start()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                while self.run_due() == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception("Scheduled message processing failed")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def schedule(self, user_id, corps_id, group_ids, everyone, message, local_time, repeat="once", spread=0):
+        """Store a message to send at local_time (a naive datetime in the ``schedule.timezone`` setting)
+
+        spread is in minutes and is capped at ``max_spread``.  Returns the schedule id.
+        """
+        run_at = local_time.replace(tzinfo=self.timezone)
+        spread = min(int(spread or 0) * 60, self.max_spread)
+        schedule_id = ScheduledMessages.create(user_id, corps_id, group_ids, everyone, message, run_at,
+                                               REPEATS[repeat], spread)
+        if run_at <= datetime.now(self.timezone):
+            self.wake()
+        return schedule_id
+
+    def local(self, when):
+        """A stored timestamp in the scheduler's timezone"""
+        return when.astimezone(self.timezone)
+
+    def run_due(self):
+        """Claim due schedules and queue their sends; returns how many were claimed"""
+        rows = ScheduledMessages.claim_due(self.batch_size, self.timezone.key)
+        for schedule_id, user_id, corps_id, group_ids, everyone, message, spread in rows:
+            try:
+                if everyone:
+                    recipients = Recipients.get_recipients_by_corps(corps_id)
+                    group_id = 0
+                else:
+                    recipients = Recipients.get_recipients_by_groups(group_ids)
+                    group_id = group_ids[0] if len(group_ids) == 1 else 0
+                job = self.queue.submit(user_id, group_id, User.get_corps_phone(corps_id), message, recipients,
+                                        corps_id=corps_id, spread=spread)
+                ScheduledMessages.record_run(schedule_id, job.id)
+                self.started += 1
+                logger.info(f"Scheduled message {schedule_id} queued as send job {job.id}")
+            except Exception:
+                logger.exception(f"Could not start scheduled message {schedule_id}")
+        return len(rows)
+
+    def stats(self):
+        return {"started": self.started}
+
+
+message_scheduler = MessageScheduler()
@@ -0,0 +1,71 @@
+from collections import namedtuple
+from config import settings
+
+# The GSM 03.38 default alphabet (less the escape character) and the characters that need
+# an escape, and so take two septets, from its extension table
+GSM7_BASIC = ("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+              "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+GSM7_EXTENDED = "\f^{}\\[~]|€"
+
+# str.translate table that deletes every GSM-7 character, so whatever is left needs UCS-2
+_strip_gsm7 = {ord(char): None for char in GSM7_BASIC + GSM7_EXTENDED}
+# str.translate table that writes extension characters as escape + character, as sent
+_escape_gsm7 = {ord(char): "\x1b" + char for char in GSM7_EXTENDED}
+
+# Characters per segment for a single message and for each part of a concatenated one,
+# whose user data header takes 7 septets / 3 UCS-2 characters
+GSM7_SINGLE, GSM7_PART = 160, 153
+UCS2_SINGLE, UCS2_PART = 70, 67
+
+# Twilio's US price per outbound segment, for cost estimates
+segment_price = settings.get("send", {}).get("segment_price", 0.0079)
+
+SegmentInfo = namedtuple("SegmentInfo", ["encoding", "units", "segments"])
+SendEstimate = namedtuple("SendEstimate", ["recipients", "segments", "ucs2", "cost"])
+
+
+def unicode_chars(text):
+    """The characters that stop text being sent as GSM-7, in order of appearance"""
+    return "".join(dict.fromkeys(text.translate(_strip_gsm7)))
+
+
+def _parts(units, part, splits_pair):
+    # Parts are cut every ``part`` units, one early where that would split an escape
+    # sequence or a UTF-16 surrogate pair
+    parts, start = 1, 0
+    while len(units) - start > part:
+        cut = start + part
+        if splits_pair(units[cut - 1]):
+            cut -= 1
+        parts += 1
+        start = cut
+    return parts
+
+
+def segment_info(text):
+    """How Twilio will encode text and how many segments it will be billed as
+
+    units is septets for GSM-7 and UTF-16 code units for UCS-2.
+    """
+    if not text:
+        return SegmentInfo("GSM-7", 0, 1)
+    if not text.translate(_strip_gsm7):
+        septets = text.translate(_escape_gsm7)
+        if len(septets) <= GSM7_SINGLE:
+            return SegmentInfo("GSM-7", len(septets), 1)
+        return SegmentInfo("GSM-7", len(septets), _parts(septets, GSM7_PART, lambda unit: unit == "\x1b"))
+    units = memoryview(text.encode("utf-16-le")).cast("H")
+    if len(units) <= UCS2_SINGLE:
+        return SegmentInfo("UCS-2", len(units), 1)
+    return SegmentInfo("UCS-2", len(units), _parts(units, UCS2_PART, lambda unit: 0xD800 <= unit < 0xDC00))
+
+
+def estimate(bodies, price=None):
+    """Total segments and cost of sending each of bodies once"""
+    segments = ucs2 = recipients = 0
+    for body in bodies:
+        info = segment_info(body)
+        recipients += 1
+        segments += info.segments
+        ucs2 += info.encoding == "UCS-2"
+    return SendEstimate(recipients, segments, ucs2, round(segments * (segment_price if price is None else price), 2))
@@ -0,0 +1,25 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """Records how long each step of starting the app took, for the log and /stats"""
+    def __init__(self):
+        self.steps = {}
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = self.steps.get(name, 0) + time.perf_counter() - start
+
+    def report(self):
+        return {name: round(seconds * 1000, 1) for name, seconds in self.steps.items()}
+
+    def summary(self):
+        return ", ".join(f"{name} {ms} ms" for name, ms in self.report().items())
+
+
+startup = StartupTimer()
@@ -1,18 +1,40 @@
 var el;
 
+// Same rules as segments.py: GSM-7 fits 160 characters (153 per part when split), and
+// anything outside it makes the whole message UCS-2 at 70 (67 per part)
+var gsm7_basic = "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?" +
+                 "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà";
+var gsm7_extended = "\f^{}\\[~]|€";
+
 function count_characters(e)  {
-  var text_entered, text_length, count_remaining, num_msg, counter;
+  var text_entered, text_length, count_remaining, num_msg, counter, single, part, i, c;
   text_entered = document.getElementById('msg').value;
-  text_length = text_entered.length;
-  if (text_length <= 160) {
-    counter = (160 - text_length);
+  text_length = 0;
+  single = 160;
+  part = 153;
+  for (i = 0; i < text_entered.length; i++) {
+    c = text_entered.charAt(i);
+    if (gsm7_basic.indexOf(c) >= 0) {
+      text_length += 1;
+    } else if (gsm7_extended.indexOf(c) >= 0) {
+      text_length += 2;
+    } else {
+      text_length = text_entered.length;
+      single = 70;
+      part = 67;
+      break;
+    }
+  };
+  if (text_length <= single) {
+    counter = (single - text_length);
   } else {
-    num_msg = parseInt(text_length/160) + 1;
-    counter = '(' + num_msg + ' messages) ' + (160 - (text_length % 160))
+    num_msg = Math.ceil(text_length/part);
+    counter = '(' + num_msg + ' messages) ' + (num_msg * part - text_length)
   };
   count_remaining = document.getElementById('remaining');
-  count_remaining.textContent = counter + '/160 remaining';
+  count_remaining.textContent = counter + '/' + (text_length <= single ? single : part) + ' remaining';
 }
 
 el = document.getElementById('msg');
 el.addEventListener('keyup', count_characters, false);
+count_characters();
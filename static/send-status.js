@@ -0,0 +1,35 @@
+var status_el;
+
+function poll_status() {
+  var request = new XMLHttpRequest();
+  request.open('GET', '/send_status/' + status_el.dataset.job);
+  request.onload = function() {
+    var job, done;
+    if (request.status != 200) {
+      status_el.textContent = 'Unable to get sending status.';
+      return;
+    }
+    job = JSON.parse(request.responseText);
+    done = job.sent + job.failed;
+    if (job.status == 'done') {
+      status_el.textContent = 'Message sent to ' + job.sent + ' of ' + job.total + ' recipients.';
+      if (job.failed > 0) {
+        status_el.textContent += ' ' + job.failed + ' could not be sent.';
+      }
+      if (job.suppressed > 0) {
+        status_el.textContent += ' ' + job.suppressed + ' skipped because they opted out.';
+      }
+    } else if (job.status == 'failed') {
+      status_el.textContent = 'Sending stopped after ' + done + ' of ' + job.total + ' recipients.';
+    } else {
+      status_el.textContent = 'Sending... ' + done + '/' + job.total;
+      setTimeout(poll_status, 1000);
+    }
+  };
+  request.send();
+}
+
+status_el = document.getElementById('send-status');
+if (status_el) {
+  poll_status();
+}
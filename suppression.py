@@ -0,0 +1,76 @@
+import threading
+import time
+from loguru import logger
+from config import settings
+from db import Suppressions
+
+
+class SuppressionList:
+    """Per-worker set of (corps_id, phone) pairs that must not be texted
+
+    Fed by STOP/START keywords and Twilio error 21610, stored in the suppressions table,
+    and kept in memory so a send can drop opted-out numbers before calling Twilio.  Other
+    workers' changes are picked up incrementally at most every ``refresh_interval`` seconds.
+    """
+    def __init__(self, refresh_interval=None):
+        cfg = settings.get("suppression", {})
+        self.refresh_interval = refresh_interval or cfg.get("refresh_interval", 30)
+        self.suppressed = 0
+        self._entries = set()
+        self._since = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        if not force and time.monotonic() - self._checked < self.refresh_interval:
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._checked < self.refresh_interval:
+                return
+            try:
+                rows = Suppressions.changed_since(self._since)
+            except Exception:
+                logger.exception("Could not refresh the suppression list")
+                return
+            for corps_id, phone, active, updated_at in rows:
+                if active:
+                    self._entries.add((corps_id, phone))
+                else:
+                    self._entries.discard((corps_id, phone))
+                if self._since is None or updated_at > self._since:
+                    self._since = updated_at
+            self._checked = time.monotonic()
+
+    def add(self, corps_id, phone, reason):
+        Suppressions.set(corps_id, phone, reason)
+        with self._lock:
+            self._entries.add((corps_id, phone))
+        logger.info(f"{phone} suppressed for corps {corps_id} ({reason})")
+
+    def remove(self, corps_id, phone):
+        Suppressions.set(corps_id, phone, "START", active=False)
+        with self._lock:
+            self._entries.discard((corps_id, phone))
+        logger.info(f"{phone} no longer suppressed for corps {corps_id}")
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def filter(self, corps_id, recipients, count=True):
+        """Split (name, phone, ...) rows into those to send to and a count of suppressed ones
+
+        Pass count=False when nothing is being sent (e.g. a preview), so the skipped
+        numbers aren't added to suppressed_sends.
+        """
+        self.refresh()
+        allowed = [recipient for recipient in recipients if (corps_id, recipient[1]) not in self._entries]
+        suppressed = len(recipients) - len(allowed)
+        if count:
+            self.suppressed += suppressed
+        return allowed, suppressed
+
+    def stats(self):
+        return {"entries": len(self._entries), "suppressed_sends": self.suppressed}
+
+
+suppressions = SuppressionList()
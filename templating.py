@@ -0,0 +1,48 @@
+import re
+from segments import segment_info, estimate, segment_price, SendEstimate
+
+# Fields a message can use, each taking the recipient's name
+FIELDS = {"name": lambda name: name,
+          "first_name": lambda name: name.split()[0] if name.strip() else name}
+
+field_re = re.compile(r"\{(" + "|".join(FIELDS) + r")\}")
+
+
+class MessageTemplate:
+    """A message with ``{name}``-style fields, parsed once and rendered per recipient
+
+    Only the names in FIELDS are fields; any other braces are sent as typed, and with
+    ``literal`` set (for text someone else wrote, like a forwarded reply) nothing is.  Literal
+    text and field functions are kept as a flat list, so rendering is a join over it with no
+    parsing.
+    """
+    def __init__(self, text, literal=False):
+        self.text = text
+        self.parts = []
+        self.fields = set()
+        start = 0
+        for match in () if literal else field_re.finditer(text):
+            if match.start() > start:
+                self.parts.append(text[start:match.start()])
+            self.fields.add(match.group(1))
+            self.parts.append(FIELDS[match.group(1)])
+            start = match.end()
+        if start < len(text):
+            self.parts.append(text[start:])
+        # A message without fields is rendered once, here
+        self.static = None if self.fields else text
+
+    def render(self, name):
+        if self.static is not None:
+            return self.static
+        return "".join(part if isinstance(part, str) else part(name) for part in self.parts)
+
+    def estimate(self, names, price=None):
+        """Segments and cost (a segments.SendEstimate) of sending to recipients with these names"""
+        if self.static is None:
+            return estimate((self.render(name) for name in names), price)
+        info = segment_info(self.static)
+        count = len(names)
+        segments = info.segments * count
+        return SendEstimate(count, segments, count if info.encoding == "UCS-2" else 0,
+                            round(segments * (segment_price if price is None else price), 2))
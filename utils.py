@@ -1,65 +1,175 @@
+import atexit
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
 import requests
-from config import settings, twilio
+from config import settings, twilio, http
 
 
-def discord_log(msg):
-    record = msg.record
-    if record["exception"] or record['level'] in ("CRITICAL", "ERROR", "WARNING"):
-        color = int.from_bytes([200, 0, 0], byteorder='big')
-    elif record['level'] == "DEBUG":
-        color = int.from_bytes([255, 255, 0], byteorder='big')
-    else:
-        color = int.from_bytes([0, 225, 0], byteorder='big')
-    payload = {
-        "embeds": [{
-            "color": color,
-            "title": f"{record['module']}:{record['function']}:{record['line']}",
-            "fields": [{"name": record['level'], "value": record['message'], "inline": False}],
-            "footer": {"text": record['time'].strftime("%Y-%m-%d %T.%f")}
-        }]
-    }
-    requests.post(settings["discord"]["webhook"], json=payload)
-    if record["exception"]:
-        e_traceback = record["exception"].traceback
-        send_exception(settings["discord"]["webhook"], e_traceback)
+# Twilio posts delivery updates for every message we send here (see inbound.StatusBuffer)
+status_callback = settings["twilio"].get("status_callback", "https://satext.com/sms/status")
 
 
-def send_exception(webhook, text, block=None):
-    """ Sends text ot channel, splitting if necessary """
-    if len(text) < 1993:
-        if block:
-            payload = {"content": f"```{text}```"}
-            requests.post(webhook, json=payload)
-        else:
-            payload = {"content": text}
-            requests.post(webhook, json=payload)
+def split_message(text, block=None, limit=1993):
+    """Split text into Discord sized messages, breaking between lines"""
+    chunks = []
+    if len(text) < limit:
+        chunks.append(text)
     else:
         coll = ""
         for line in text.splitlines(keepends=True):
-            if len(coll) + len(line) > 1993:
+            if len(coll) + len(line) > limit:
                 # if collecting is going to be too long, send  what you have so far
-                if block:
-                    payload = {"content": f"```{coll}```"}
-                    requests.post(webhook, json=payload)
-                else:
-                    payload = {"content": coll}
-                    requests.post(webhook, json=payload)
+                chunks.append(coll)
                 coll = ""
             coll += line
-        if block:
-            payload = {"content": f"```{coll}```"}
-            requests.post(webhook, json=payload)
+        chunks.append(coll)
+    if block:
+        return [f"```{chunk}```" for chunk in chunks]
+    return chunks
+
+
+class DiscordSink:
+    """Loguru sink that posts records to a Discord webhook from a background thread
+
+    Records wait in a bounded queue and are posted up to ten embeds at a time.  When the
+    queue is full the oldest record is dropped (and counted) so logging never blocks a
+    request, and 429 responses are retried after the delay Discord asks for.
+    """
+    max_embeds = 10
+
+    def __init__(self, webhook, max_queue=1000, timeout=10):
+        self.webhook = webhook
+        self.timeout = timeout
+        self.dropped = 0
+        self.posted = 0
+        self.rate_limited = 0
+        self._queue = deque()
+        self._max_queue = max_queue
+        self._cond = threading.Condition()
+        self._pid = None
+        self._busy = False
+
+    def __call__(self, msg):
+        record = msg.record
+        if record["exception"] or record['level'].name in ("CRITICAL", "ERROR", "WARNING"):
+            color = int.from_bytes([200, 0, 0], byteorder='big')
+        elif record['level'].name == "DEBUG":
+            color = int.from_bytes([255, 255, 0], byteorder='big')
         else:
-            payload = {"content": coll}
-            requests.post(webhook, json=payload)
+            color = int.from_bytes([0, 225, 0], byteorder='big')
+        embed = {
+            "color": color,
+            "title": f"{record['module']}:{record['function']}:{record['line']}",
+            "fields": [{"name": record['level'].name, "value": record['message'][:1024], "inline": False}],
+            "footer": {"text": record['time'].strftime("%Y-%m-%d %T.%f")}
+        }
+        items = [("embed", embed)]
+        if record["exception"]:
+            exc_type, exc_value, exc_tb = record["exception"]
+            e_traceback = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
+            items.extend(("content", chunk) for chunk in split_message(e_traceback, block=True))
+        self.put(items)
+
+    def put(self, items):
+        self._start()
+        with self._cond:
+            for item in items:
+                if len(self._queue) >= self._max_queue:
+                    self._queue.popleft()
+                    self.dropped += 1
+                self._queue.append(item)
+            self._cond.notify()
+
+    def flush(self, timeout=5):
+        """Wait up to timeout seconds for queued records to be posted"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._queue or self._busy) and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+
+    def _start(self):
+        # Threads don't survive a fork, so each worker starts its own
+        if self._pid != os.getpid():
+            with self._cond:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._run, name="discord-log", daemon=True).start()
+
+    def _next_payload(self):
+        kind, item = self._queue.popleft()
+        if kind == "content":
+            return {"content": item}
+        embeds = [item]
+        while self._queue and len(embeds) < self.max_embeds and self._queue[0][0] == "embed":
+            embeds.append(self._queue.popleft()[1])
+        return {"embeds": embeds}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._busy = False
+                    self._cond.notify_all()
+                    self._cond.wait()
+                self._busy = True
+                payload = self._next_payload()
+            self._post(payload)
+
+    def _post(self, payload):
+        # Never log from here; the record would come straight back to this sink
+        for attempt in range(5):
+            try:
+                response = http.post(self.webhook, json=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                sys.stderr.write(f"Discord log post failed: {e}\n")
+                return
+            if response.status_code != 429:
+                if response.ok:
+                    self.posted += 1
+                else:
+                    sys.stderr.write(f"Discord log post failed: {response.status_code} {response.text}\n")
+                return
+            self.rate_limited += 1
+            try:
+                retry_after = float(response.json()["retry_after"])
+            except (ValueError, KeyError, TypeError):
+                retry_after = float(response.headers.get("Retry-After", 1))
+            time.sleep(retry_after)
+        sys.stderr.write("Discord log post dropped after repeated rate limiting\n")
+
+    def stats(self):
+        return {"queued": len(self._queue),
+                "posted": self.posted,
+                "dropped": self.dropped,
+                "rate_limited": self.rate_limited}
+
+
+discord_log = DiscordSink(settings["discord"]["webhook"],
+                          max_queue=settings["discord"].get("max_queue", 1000))
+atexit.register(discord_log.flush)
+
+
+def send_exception(webhook, text, block=None):
+    """ Sends text ot channel, splitting if necessary """
+    for chunk in split_message(text, block):
+        http.post(webhook, json={"content": chunk})
+
+
+# Message template (see templating.py) for welcoming new recipients
+welcome_recipients_body = ("Welcome {name}! You've been added to a group for Salvation Army text messages. "
+                           "If you have questions, talk to your corps officers. Text 'STOP' to cancel messages.")
 
 
 def welcome_recipient(recipient_id, name, phone, from_phone):
-    body = (f"Welcome {name}! You've been added to a group for Salvation Army text messages. "
-            f"If you have questions, talk to your corps officers. Text 'STOP' to cancel messages.")
+    body = welcome_recipients_body.format(name=name)
     twilio_msg = twilio.messages.create(to=phone,
                                         from_=from_phone,
-                                        body=body)
+                                        body=body,
+                                        status_callback=status_callback)
     return twilio_msg.sid, "WELCOME", recipient_id, 0, body
 
 
@@ -68,7 +178,8 @@ def welcome_user(user_id, name, phone, from_phone):
             f"Start now at https://satext.com.")
     twilio_msg = twilio.messages.create(to=phone,
                                         from_=from_phone,
-                                        body=body)
+                                        body=body,
+                                        status_callback=status_callback)
     return twilio_msg.sid, user_id, 0, 0, body
 
 